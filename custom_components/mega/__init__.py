@@ -12,6 +12,7 @@ from homeassistant.const import (
 )
 from homeassistant.core import HomeAssistant, ServiceCall
 from homeassistant.helpers.service import bind_hass
+from homeassistant.helpers.reload import async_integration_yaml_config
 from homeassistant.helpers import config_validation as cv
 from homeassistant.config_entries import ConfigEntry
 from .const import DOMAIN, CONF_INVERT, CONF_RELOAD, PLATFORMS, CONF_PORTS, CONF_CUSTOM, CONF_SKIP, CONF_PORT_TO_SCAN, \
@@ -19,7 +20,8 @@ from .const import DOMAIN, CONF_INVERT, CONF_RELOAD, PLATFORMS, CONF_PORTS, CONF
     CONF_CONV_TEMPLATE, CONF_ALL, CONF_FORCE_D, CONF_DEF_RESPONSE, CONF_FORCE_I2C_SCAN, CONF_HEX_TO_FLOAT, \
     RGB_COMBINATIONS, CONF_WS28XX, CONF_ORDER, CONF_SMOOTH, CONF_LED, CONF_WHITE_SEP, CONF_CHIP, CONF_RANGE, \
     CONF_FILTER_VALUES, CONF_FILTER_SCALE, CONF_FILTER_LOW, CONF_FILTER_HIGH, CONF_FILL_NA, CONF_MEGA_ID, CONF_ADDR, \
-    CONF_1WBUS
+    CONF_1WBUS, CONF_CONCURRENCY, CONF_REFRESH_DELAY, CONF_REFRESH_MAX_DELAY, \
+    CONF_FULL_SYNC, CONF_READ_FRESHNESS, CONF_TRACE_POLL
 from .hub import MegaD
 from .config_flow import ConfigFlow
 from .http import MegaView
@@ -140,6 +142,18 @@ CONFIG_SCHEMA = vol.Schema(
                 vol.Optional(CONF_FILTER_SCALE): vol.Coerce(float),
                 vol.Optional(CONF_FILTER_LOW): vol.Coerce(float),
                 vol.Optional(CONF_FILTER_HIGH): vol.Coerce(float),
+                vol.Optional(CONF_CONCURRENCY, description='кол-во одновременных запросов к контроллеру'):
+                    vol.All(int, vol.Range(min=1)),
+                vol.Optional(CONF_REFRESH_DELAY, description='задержка обновления после события, сек'):
+                    vol.All(vol.Coerce(float), vol.Range(min=0)),
+                vol.Optional(CONF_REFRESH_MAX_DELAY, description='максимальная задержка обновления, сек'):
+                    vol.All(vol.Coerce(float), vol.Range(min=0)),
+                vol.Optional(CONF_FULL_SYNC, description='раз в сколько циклов опроса обновлять все объекты'):
+                    vol.All(int, vol.Range(min=0)),
+                vol.Optional(CONF_READ_FRESHNESS, description='сколько секунд ответ на чтение считается свежим'):
+                    vol.All(vol.Coerce(float), vol.Range(min=0)),
+                vol.Optional(CONF_TRACE_POLL, description='сколько последних циклов опроса трассировать'):
+                    vol.All(int, vol.Range(min=0)),
             },
             vol.Optional(CONF_1WBUS): [OWBUS]
         }
@@ -179,6 +193,7 @@ async def async_setup(hass: HomeAssistant, config: dict):
             vol.Optional('mega_id'): str,
         })
     )
+    hass.services.async_register(DOMAIN, 'reload', partial(_reload_yaml_service, hass))
 
     return True
 
@@ -287,6 +302,22 @@ async def _save_service(hass: HomeAssistant, call: ServiceCall):
                 await hub.save()
 
 
+@bind_hass
+async def _reload_yaml_service(hass: HomeAssistant, call: ServiceCall):
+    """
+    Перечитывает кастомизации из configuration.yaml без перезагрузки интеграции
+    """
+    config = await async_integration_yaml_config(hass, DOMAIN)
+    if config is None:
+        return
+    custom = config.get(DOMAIN, {})
+    hass.data[DOMAIN][CONF_CUSTOM] = custom
+    hass.data[DOMAIN][CONF_HTTP].update_templates(custom)
+    for hub in hass.data[DOMAIN][CONF_ALL].values():
+        if isinstance(hub, MegaD):
+            hub.invalidate_customize()
+
+
 @bind_hass
 async def _get_port(hass: HomeAssistant, call: ServiceCall):
     port = call.data.get('port')
@@ -14,12 +14,14 @@ from homeassistant.const import (
     CONF_UNIQUE_ID,
     CONF_ID,
     CONF_ENTITY_ID,
+    STATE_ON,
 )
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.template import Template
 from .const import EVENT_BINARY_SENSOR, DOMAIN, CONF_CUSTOM, CONF_SKIP, CONF_INVERT, CONF_RESPONSE_TEMPLATE
 from .entities import  MegaPushEntity
 from .hub import MegaD
+from .state import SOURCE_PUSH
 from .tools import int_ignore
 
 lg = logging.getLogger(__name__)
@@ -67,7 +69,7 @@ class MegaBinarySensor(BinarySensorEntity, MegaPushEntity):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.mega.binary_sensors.append(self.port)
+        self.mega.binary_sensors.add(self.port)
         self._is_on = None
         self._attrs = None
         self._click_task = None
@@ -85,17 +87,14 @@ class MegaBinarySensor(BinarySensorEntity, MegaPushEntity):
 
     @property
     def is_on(self) -> bool:
-        val = self.mega.values.get(self.port, {})
-        if isinstance(val, dict):
-            val = val.get("value", val.get('m'))
-        if val is None and self._state is not None:
-            return self._state == 'ON'
-        elif val is not None:
-            if val in ['ON', 'OFF', '1', '0']:
-                return val in ['ON', '1'] if not self.invert else val in ['OFF', '0']
-            elif isinstance(val, int):
-                return val != 1 if not self.invert else val == 1
+        state = self.mega.values.get(self.port)
+        if state is None or (state.value is None and state.is_on is None):
+            if self._state is not None:
+                return self._state.state == STATE_ON
+            return None
+        if state.is_on is None:
+            return None
+        return state.is_on if not self.invert else not state.is_on
 
     def _update(self, payload: dict):
-        self.mega.values[self.port] = payload
-
+        self.mega.values.set(self.port, payload, SOURCE_PUSH)
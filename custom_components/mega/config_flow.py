@@ -44,6 +44,7 @@ async def get_hub(hass: HomeAssistant, data):
     hub = MegaD(hass, **data, lg=_LOGGER, loop=asyncio.get_event_loop()) #mqtt=_mqtt,
     hub.mqtt_id = await hub.get_mqtt_id()
     if not await hub.authenticate():
+        await hub.stop()
         raise exceptions.InvalidAuth
     return hub
 
@@ -79,7 +80,7 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             hub = await validate_input(self.hass, user_input)
             await hub.start()
             hub.new_naming=True
-            config = await hub.get_config(nports=user_input.get(CONF_NPORTS, 37))
+            config = await hub.get_config(nports=user_input.get(CONF_NPORTS, 37), use_cache=False)
             await hub.stop()
             hub.lg.debug(f'config loaded: %s', config)
             config.update(user_input)
@@ -122,12 +123,13 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
             cfg.update(user_input)
             cfg['new_naming'] = new_naming
             self.config_entry.data = cfg
-            await get_hub(self.hass, cfg)
+            await (await get_hub(self.hass, cfg)).stop()
 
             if reload:
                 id = self.config_entry.data.get('id', self.config_entry.entry_id)
                 hub: MegaD = self.hass.data[DOMAIN].get(id)
-                cfg = await hub.reload(reload_entry=False)
+                # явный запрос пользователя на пересканирование, кеш не используем
+                cfg = await hub.reload(reload_entry=False, use_cache=False)
 
             return self.async_create_entry(
                 title='',
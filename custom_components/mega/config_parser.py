@@ -1,7 +1,9 @@
+import re
 from dataclasses import dataclass, field
-from bs4 import BeautifulSoup
+from html import unescape
 
 inputs = [
+    'ecmd',
     'eact',
     'inta',
     'misc',
@@ -14,6 +16,11 @@ selectors = [
     'ety',
 ]
 
+# страницы меги небольшие и однотипные, поэтому вместо построения DOM просто проходим по тегам
+TAG_PATT = re.compile(r'''<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:"[^"]*"|'[^']*'|[^'">])*)>''')
+ATTR_PATT = re.compile(r'''([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?''')
+I2C_SCAN = 'I2C Scan'
+
 
 @dataclass(frozen=True, eq=True)
 class Config:
@@ -25,29 +32,63 @@ class Config:
     inta: str = field(compare=False, hash=False, default=None)
     misc: str = field(compare=False, hash=False, default=None)
     eact: str = field(compare=False, hash=False, default=None)
-    src: BeautifulSoup = field(compare=False, hash=False, default=None)
+    ecmd: str = field(compare=False, hash=False, default=None)
+    i2c_scan: bool = field(compare=False, hash=False, default=False)
+
+
+def parse_attrs(attrs: str) -> dict:
+    ret = {}
+    for m in ATTR_PATT.finditer(attrs):
+        name, dq, sq, bare = m.groups()
+        name = name.lower()
+        if name in ret:
+            continue
+        v = dq if dq is not None else sq if sq is not None else bare
+        ret[name] = unescape(v) if v else v
+    return ret
 
 
 def parse_config(page: str):
-    page = BeautifulSoup(page, features="lxml")
+    """
+    Разбор страницы настроек порта: значения выбранных option в select'ах, значения input'ов и наличие
+    ссылки I2C Scan
+    """
     ret = {}
-    for x in selectors:
-        v = page.find('select', attrs={'name': x})
-        if v is None:
+    misc_checked = False
+    select = None
+    link_end = None
+    i2c_scan = False
+    for m in TAG_PATT.finditer(page):
+        closing, tag, attrs = m.groups()
+        tag = tag.lower()
+        if link_end is not None:
+            if tag == 'a' and closing and page[link_end:m.start()].strip() == I2C_SCAN:
+                i2c_scan = True
+            link_end = None
+        if closing:
+            if tag == 'select':
+                select = None
             continue
-        else:
-            v = v.find(selected=True)
-            if v:
-                v = v['value']
-                ret[x] = v
-    for x in inputs:
-        v = page.find('input', attrs={'name': x})
-        if v:
-            ret[x] = v['value']
-    smooth = page.find('input', attrs={'name': 'misc'})
-    if smooth is None or smooth.get('checked') is None:
+        if tag == 'a':
+            link_end = m.end()
+        elif tag == 'select':
+            name = parse_attrs(attrs).get('name')
+            select = name if name in selectors and name not in ret else None
+        elif tag == 'option' and select is not None:
+            attrs = parse_attrs(attrs)
+            if 'selected' in attrs:
+                ret[select] = attrs.get('value')
+                select = None
+        elif tag == 'input':
+            attrs = parse_attrs(attrs)
+            name = attrs.get('name')
+            if name in inputs and name not in ret:
+                ret[name] = attrs.get('value')
+                if name == 'misc':
+                    misc_checked = 'checked' in attrs
+    if not misc_checked:
         ret['misc'] = None
-    return Config(**ret, src=page)
+    return Config(**ret, i2c_scan=i2c_scan)
 
 
 DIGITAL_IN = Config(pty="0")
@@ -59,4 +100,3 @@ MCP230_OUT = Config(ety="1")
 MCP230_IN = Config(ety="0")
 PCA9685 = Config(pty="4", m="1", gr="3", d="21")
 OWIRE_BUS = Config(pty="3", d="5")
-
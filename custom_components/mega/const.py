@@ -52,6 +52,19 @@ CONF_FILTER_LOW = 'filter_low'
 CONF_FILTER_HIGH = 'filter_high'
 CONF_1WBUS = '1wbus'
 CONF_ADDR = 'addr'
+CONF_CONCURRENCY = 'concurrency'
+CONF_REFRESH_DELAY = 'refresh_delay'
+CONF_REFRESH_MAX_DELAY = 'refresh_max_delay'
+CONF_FULL_SYNC = 'full_sync'
+CONF_READ_FRESHNESS = 'read_freshness'
+CONF_TRACE_POLL = 'trace_poll'
+# команды портов, отправленные в течение CMD_BATCH_WINDOW секунд, склеиваются в одну команду не длиннее CMD_MAX_LEN
+CMD_BATCH_WINDOW = 0.005
+CMD_MAX_LEN = 200
+# приоритеты запросов к контроллеру (меньше - раньше): команды пользователя, обычные запросы, опрос
+PRIORITY_COMMAND = -1
+PRIORITY_DEFAULT = 0
+PRIORITY_POLL = 1
 PLATFORMS = [
     "light",
     "switch",
@@ -60,6 +73,7 @@ PLATFORMS = [
 ]
 EVENT_BINARY_SENSOR = f'{DOMAIN}.sensor'
 EVENT_BINARY = f'{DOMAIN}.binary'
+EVENT_DS2413_MISMATCH = f'{DOMAIN}.ds2413_mismatch'
 
 PATT_SPLIT = re.compile('[;/]')
 
@@ -72,11 +86,16 @@ SINGLE_CLICK = 'single'
 DOUBLE_CLICK = 'double'
 
 PATT_FW = re.compile(r'fw:\s(.+?)\)')
+# порты, на которые ссылается сценарий (act) порта: 7:1, 10e3:0, 30A:1
+PATT_ACT_PORT = re.compile(r'(?:^|;)(\d+)(?:e(\d+))?([AaBb])?:')
+# одна команда порта вида pt:v, такие команды можно склеивать
+PATT_PORT_CMD = re.compile(r'^\d+(?:e\d+)?:[^;]+$')
 
 REMOVE_CONFIG = [
     'extenders',
     'ext_in',
     'ext_acts',
+    'acts',
     'i2c_sensors',
     'binary_sensor',
     'light',
@@ -0,0 +1,41 @@
+"""Диагностика интеграции"""
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import CONF_ID, CONF_PASSWORD
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+from .hub import MegaD
+
+TO_REDACT = {CONF_PASSWORD}
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry) -> dict:
+    hub: MegaD = hass.data[DOMAIN].get(entry.data.get(CONF_ID, entry.entry_id))
+    ret = {
+        "config": async_redact_data(dict(entry.data), TO_REDACT),
+        "options": async_redact_data(dict(entry.options or {}), TO_REDACT),
+    }
+    if hub is None:
+        return ret
+    ret.update(
+        fw=hub.fw,
+        online=hub.online,
+        metrics=hub.metrics.as_dict(),
+        rtt={
+            "p50": hub.rtt.value(0.5),
+            "p95": hub.rtt.value(0.95),
+            "timeout": hub.rtt.timeout(),
+        },
+        breaker=dict(hub.breaker.stats, open=hub.breaker.is_open, failures=hub.breaker.failures),
+        scheduler=hub.scheduler.stats,
+        connection=hub.conn_stats,
+        poll=hub.poll_stats,
+        reads=hub.read_stats,
+        refresh=hub.refresher.stats,
+        commands=hub.commands.stats,
+        dimmer=dict(hub.dimmer.stats, tick=hub.dimmer.tick, rtt=hub.dimmer.rtt),
+        ds2413=hub.ds2413_stats,
+        traces=hub.tracer.as_list(),
+    )
+    return ret
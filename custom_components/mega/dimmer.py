@@ -0,0 +1,242 @@
+"""Программное плавное диммирование"""
+import asyncio
+import logging
+import time
+import typing
+
+from .const import CMD_MAX_LEN
+from .tools import join_cmds
+
+if typing.TYPE_CHECKING:
+    from .hub import MegaD
+
+# минимальный и максимальный интервал между командами диммирования
+MIN_TICK = 0.05
+MAX_TICK = 0.5
+# запас по времени поверх времени ответа контроллера, чтобы между кадрами успевали проходить остальные запросы
+TICK_RTT_RATIO = 1.5
+# коэффициент сглаживания времени ответа
+RTT_ALPHA = 0.3
+
+
+class Transition:
+    """
+    Одно плавное изменение значений нескольких портов
+
+    channels - [(port, from, to), ...]
+    hardware - индексы каналов, которые диммирует сам контроллер (аппаратный smooth): команды для них не
+    отправляются, значения только рассчитываются для updater
+    stats - отправлено кадров, пропущено кадров относительно номинальной частоты (когда контроллер не успевает),
+    опоздание последнего кадра, максимальный такт за время перехода
+    """
+    __slots__ = (
+        'channels', 'start', 'duration', 'updater', 'ws', 'chip', 'hardware', 'last', 'future', 'stats',
+    )
+
+    def __init__(
+        self,
+        channels: typing.List[typing.Tuple[typing.Any, int, int]],
+        duration: float,
+        updater: typing.Callable[[tuple], typing.Any] = None,
+        ws=False,
+        chip=None,
+        hardware: typing.Collection[int] = (),
+    ):
+        self.channels = channels
+        self.start = time.monotonic()
+        self.duration = duration
+        self.updater = updater
+        self.ws = ws
+        self.chip = chip
+        self.hardware = frozenset(hardware)
+        self.last = None
+        self.future: asyncio.Future = asyncio.get_event_loop().create_future()
+        self.stats = {
+            "sent": 0,
+            "dropped": 0,
+            "overrun": 0.0,
+            "tick": 0.0,
+        }
+
+    @property
+    def ports(self):
+        return [pt for pt, _, _ in self.channels]
+
+    @property
+    def send(self) -> bool:
+        return len(self.hardware) < len(self.channels)
+
+    @property
+    def end(self) -> float:
+        return self.start + max(self.duration, 0)
+
+    def nominal_frames(self, min_tick: float) -> int:
+        """
+        Сколько кадров было бы отправлено с тактом min_tick, но не больше, чем шагов значения у программных каналов
+        """
+        steps = max(
+            [abs(t - f) for i, (_, f, t) in enumerate(self.channels) if i not in self.hardware] or [0]
+        )
+        return max(min(int(self.duration / min_tick), steps), 1)
+
+    def frame(self, now: float) -> typing.Tuple[tuple, bool]:
+        """
+        Значения портов на момент now
+        :return: значения, признак последнего кадра
+        """
+        if self.duration <= 0:
+            pct = 1
+        else:
+            pct = min((now - self.start) / self.duration, 1)
+        return tuple(f + round((t - f) * pct) for _, f, t in self.channels), pct >= 1
+
+    def finish(self, result=True):
+        if not self.future.done():
+            self.future.set_result(result)
+
+
+class DimmingEngine:
+    """
+    Плавное диммирование всех светильников контроллера одним циклом: на каждом такте значения всех активных
+    переходов рассчитываются по time.monotonic() и отправляются одной командой cmd=pt:v;pt:v;...
+    Интервал между тактами подстраивается под время ответа контроллера
+    """
+
+    def __init__(self, hub: 'MegaD', min_tick=MIN_TICK, max_tick=MAX_TICK):
+        self.hub = hub
+        self.min_tick = min_tick
+        self.max_tick = max_tick
+        self.tick = min_tick
+        self.rtt: typing.Optional[float] = None
+        self._active: typing.List[Transition] = []
+        self._task: typing.Optional[asyncio.Task] = None
+        self.stats = {
+            "transitions": 0,
+            "sent": 0,
+            "dropped": 0,
+            "overrun_max": 0.0,
+            "tick_max": 0.0,
+            "last": None,
+        }
+
+    @property
+    def lg(self) -> logging.Logger:
+        return self.hub.lg
+
+    def start(
+        self,
+        *config: typing.Tuple[typing.Any, int, int],
+        time: float,
+        updater=None,
+        ws=False,
+        chip=None,
+        hardware: typing.Collection[int] = (),
+    ) -> Transition:
+        """
+        Запуск перехода, переходы, которые управляли теми же портами, завершаются
+        """
+        tr = Transition(list(config), time, updater=updater, ws=ws, chip=chip, hardware=hardware)
+        self.lg.debug("dim %s for %s seconds", tr.channels, time)
+        ports = set(tr.ports)
+        for x in [x for x in self._active if ports.intersection(x.ports)]:
+            self.discard(x, result=False)
+        self._active.append(tr)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return tr
+
+    def discard(self, tr: Transition, result=False):
+        if tr in self._active:
+            self._active.remove(tr)
+        tr.finish(result)
+
+    def stop(self):
+        for tr in self._active[:]:
+            self.discard(tr)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _adapt_tick(self, rtt: float):
+        self.rtt = rtt if self.rtt is None else self.rtt + RTT_ALPHA * (rtt - self.rtt)
+        self.tick = min(max(self.rtt * TICK_RTT_RATIO, self.min_tick), self.max_tick)
+        self.stats["tick_max"] = max(self.stats["tick_max"], self.tick)
+        for tr in self._active:
+            tr.stats["tick"] = max(tr.stats["tick"], round(self.tick, 3))
+
+    async def _run(self):
+        while self._active:
+            beg = time.monotonic()
+            await self._step(beg)
+            if not self._active:
+                break
+            now = time.monotonic()
+            delay = self.tick - (now - beg)
+            # последний кадр не должен ждать полный такт, иначе переход закончится позже заданного времени
+            lag = (self.rtt or 0) / 2
+            delay = min([delay] + [tr.end - lag - now for tr in self._active])
+            await asyncio.sleep(max(delay, 0))
+
+    def _finish(self, tr: Transition, landed: float):
+        tr.stats["overrun"] = round(max(landed - tr.end, 0), 3)
+        if tr.send:
+            tr.stats["dropped"] = max(tr.nominal_frames(self.min_tick) - tr.stats["sent"], 0)
+        self.stats["transitions"] += 1
+        self.stats["sent"] += tr.stats["sent"]
+        self.stats["dropped"] += tr.stats["dropped"]
+        self.stats["overrun_max"] = max(self.stats["overrun_max"], tr.stats["overrun"])
+        self.stats["last"] = dict(tr.stats)
+        self.lg.debug("dim %s finished: %s", tr.channels, tr.stats)
+        self.discard(tr, result=True)
+
+    async def _step(self, now: float):
+        cmd = []
+        ws = []
+        done = []
+        # кадр рассчитывается на момент, когда команда дойдет до контроллера, поэтому если контроллер отвечает
+        # медленно, промежуточные кадры пропускаются. Последний кадр отправляется уже сейчас, если к следующему такту
+        # он опоздал бы
+        lag = (self.rtt or 0) / 2
+        for tr in self._active[:]:
+            if now + self.tick + lag > tr.end:
+                values, last = tr.frame(tr.end)
+            else:
+                values, last = tr.frame(now + lag)
+            if last:
+                done.append(tr)
+            if values == tr.last:
+                continue
+            tr.last = values
+            if tr.updater is not None:
+                tr.updater(values)
+            if not tr.send:
+                continue
+            tr.stats["sent"] += 1
+            if tr.ws:
+                ws.append((tr, values))
+            else:
+                cmd.extend(f"{pt}:{values[i]}" for i, pt in enumerate(tr.ports) if i not in tr.hardware)
+        requests = []
+        for x in join_cmds(cmd, CMD_MAX_LEN):
+            requests.append(self.hub.request(cmd=x))
+        for tr, values in ws:
+            # для адресных лент
+            requests.append(self.hub.request(
+                pt=tr.channels[0][0],
+                chip=tr.chip,
+                ws="".join([hex(x).split("x")[1].rjust(2, "0").upper() for x in values]),
+            ))
+        landed = now
+        if requests:
+            beg = time.monotonic()
+            results = await asyncio.gather(*requests, return_exceptions=True)
+            rtt = time.monotonic() - beg
+            self._adapt_tick(rtt)
+            # команда применяется контроллером примерно в середине запроса
+            landed = beg + rtt / 2
+            for x in results:
+                if isinstance(x, BaseException):
+                    self.lg.warning("while dimming: %r", x)
+        for tr in done:
+            if tr in self._active:
+                self._finish(tr, landed)
@@ -0,0 +1,64 @@
+"""Кеш результатов сканирования контроллеров"""
+import asyncio
+import hashlib
+import typing
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+
+from .const import DOMAIN
+
+STORAGE_KEY = f"{DOMAIN}.discovery"
+STORAGE_VERSION = 1
+# версия формата фрагментов: записи другой версии (например, без acts) не используются
+CACHE_VERSION = 3
+DATA_DISCOVERY_CACHE = f"{DOMAIN}_discovery_cache"
+
+
+def page_hash(page: str) -> str:
+    return hashlib.sha1(page.encode("utf-8", "replace")).hexdigest()
+
+
+class DiscoveryCache:
+    """
+    Кеш сканирования, хранится в .storage. Для каждого контроллера запоминается версия прошивки, кол-во портов и
+    для каждого порта хеш страницы настроек вместе с результатом сканирования этого порта. Если прошивка и страница
+    не изменились, порт повторно не разбирается и не сканируется
+    """
+
+    def __init__(self, hass: HomeAssistant):
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._data: typing.Optional[dict] = None
+        self._lck = asyncio.Lock()
+
+    async def _load(self) -> dict:
+        async with self._lck:
+            if self._data is None:
+                self._data = await self._store.async_load() or {}
+        return self._data
+
+    @staticmethod
+    def _key(fw: str, new_naming: bool, nports: int) -> dict:
+        return {"version": CACHE_VERSION, "fw": fw, "new_naming": new_naming, "nports": nports}
+
+    async def get(self, mega_id: str, fw: str, new_naming: bool, nports: int) -> dict:
+        """
+        :return: словарь {порт: {"hash": ..., "ext": ..., "fragment": ...}}, пустой если кеш устарел
+        """
+        data = (await self._load()).get(mega_id)
+        key = self._key(fw, new_naming, nports)
+        if not data or any(data.get(k) != v for k, v in key.items()):
+            return {}
+        return data.get("ports", {})
+
+    async def save(self, mega_id: str, fw: str, new_naming: bool, nports: int, ports: dict):
+        data = await self._load()
+        data[mega_id] = dict(self._key(fw, new_naming, nports), ports=ports)
+        await self._store.async_save(data)
+
+
+def get_discovery_cache(hass: HomeAssistant) -> DiscoveryCache:
+    cache = hass.data.get(DATA_DISCOVERY_CACHE)
+    if cache is None:
+        cache = hass.data[DATA_DISCOVERY_CACHE] = DiscoveryCache(hass)
+    return cache
@@ -1,19 +1,21 @@
 import logging
 import asyncio
-import time
 import typing
 from datetime import timedelta
 from functools import partial
 
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import CONF_NAME
+from homeassistant.const import CONF_NAME, STATE_ON
 from homeassistant.core import State
 from homeassistant.helpers.entity import DeviceInfo
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 from homeassistant.helpers.restore_state import RestoreEntity
 from . import hub as h
+from .state import SOURCE_OPTIMISTIC, token_is_on
+from .tools import IntentQueue
 from .const import DOMAIN, CONF_CUSTOM, CONF_INVERT, EVENT_BINARY_SENSOR, LONG, \
-    LONG_RELEASE, RELEASE, PRESS, SINGLE_CLICK, DOUBLE_CLICK, EVENT_BINARY, CONF_SMOOTH, CONF_RANGE
+    LONG_RELEASE, RELEASE, PRESS, SINGLE_CLICK, DOUBLE_CLICK, EVENT_BINARY, CONF_SMOOTH, CONF_RANGE, \
+    PRIORITY_COMMAND
 
 _events_on = False
 _LOGGER = logging.getLogger(__name__)
@@ -61,7 +63,6 @@ class BaseMegaEntity(CoordinatorEntity, RestoreEntity):
         self.port = port
         self.config_entry = config_entry
         self.mega = mega
-        mega.entities.append(self)
         self._mega_id = mega.id
         self._lg = None
         if not isinstance(port, list):
@@ -71,6 +72,7 @@ class BaseMegaEntity(CoordinatorEntity, RestoreEntity):
             self._name = name or f"{mega.id}_{_pt}" + \
                          (f"_{id_suffix}" if id_suffix else "")
             self._customize: dict = None
+            self._customize_fixed = False
         else:
             assert id_suffix is not None
             assert name is not None
@@ -78,6 +80,7 @@ class BaseMegaEntity(CoordinatorEntity, RestoreEntity):
             self._unique_id = unique_id or f"mega_{mega.id}_{id_suffix}"
             self._name = name
             self._customize = customize
+            self._customize_fixed = True
 
         self.index = index
         self.addr = addr
@@ -86,11 +89,25 @@ class BaseMegaEntity(CoordinatorEntity, RestoreEntity):
         if self.http_cmd == 'ds2413':
             self.mega.ds2413_ports |= {self.port}
         super().__init__(coordinator=mega.updater)
+        mega.add_entity(self)
 
     @property
     def is_ws(self):
         return False
 
+    @property
+    def state_keys(self) -> tuple:
+        """
+        Ключи mega.values, от которых зависит состояние объекта
+        """
+        return tuple(self.port) if isinstance(self.port, list) else (self.port, )
+
+    def _handle_coordinator_update(self) -> None:
+        # обновления координатора раздает хаб по индексу портов только изменившимся объектам,
+        # см. MegaD._dispatch_update
+        pass
+
+
     def get_attribute(self, name, default=None):
         attr = getattr(self, f'_{name}', None)
         if attr is None and self._state is not None:
@@ -102,18 +119,17 @@ class BaseMegaEntity(CoordinatorEntity, RestoreEntity):
 
     @property
     def can_smooth_hardware(self):
+        """
+        Хотя бы один из портов объекта поддерживает аппаратный smooth, какие именно порты диммирует контроллер,
+        решает MegaD.plan_smooth
+        """
         if self._can_smooth_hard is None:
             if self.is_ws:
                 self._can_smooth_hard = False
-            if not isinstance(self.port, list):
-                self._can_smooth_hard = self.port in self.mega.smooth
+            elif not isinstance(self.port, list):
+                self._can_smooth_hard = self.mega.can_smooth_port(self.port)
             else:
-                for x in self.port:
-                    if isinstance(x, str):
-                        self._can_smooth_hard = False
-                        break
-                    else:
-                        self._can_smooth_hard = self.port in self.mega.smooth
+                self._can_smooth_hard = any(self.mega.can_smooth_port(x) for x in self.port)
         return self._can_smooth_hard
 
     @property
@@ -124,24 +140,34 @@ class BaseMegaEntity(CoordinatorEntity, RestoreEntity):
             return super().enabled
 
     @property
-    def customize(self):
+    def customize(self) -> dict:
+        """
+        Кастомизация объекта из yaml. Вычисляется один раз после добавления объекта в HA, сбрасывается только при
+        перезагрузке yaml (см. invalidate_customize)
+        """
         if self._customize is not None:
             return self._customize
         if self.hass is None or self.entity_id is None:
             return {}
-        if self._customize is None:
-            c_entity_id = self.hass.data.get(DOMAIN, {}).get(CONF_CUSTOM).get('entities', {}).get(self.entity_id, {})
-            c = self.hass.data.get(DOMAIN, {}).get(CONF_CUSTOM) or {}
-            c = c.get(self._mega_id) or {}
-            c = c.get(self.port) or {}
-            if self.addr is not None and self.index is not None and isinstance(c, dict):
-                idx = self.addr.lower() + f'_a' if self.index == 0 else '_b'
-                c = c.get(idx, {})
-            c.update(c_entity_id)
-            self._customize = c
-
+        self._customize = self._resolve_customize()
         return self._customize
 
+    def _resolve_customize(self) -> dict:
+        custom = self.hass.data.get(DOMAIN, {}).get(CONF_CUSTOM) or {}
+        c = custom.get(self._mega_id) or {}
+        c = c.get(self.port) or {}
+        if self.addr is not None and self.index is not None and isinstance(c, dict):
+            idx = self.addr.lower() + ('_a' if self.index == 0 else '_b')
+            c = c.get(idx, {})
+        # копия, чтобы не менять исходный конфиг
+        c = dict(c)
+        c.update((custom.get('entities') or {}).get(self.entity_id, {}))
+        return c
+
+    def invalidate_customize(self):
+        if not self._customize_fixed:
+            self._customize = None
+
     @property
     def device_info(self) -> DeviceInfo:
         if isinstance(self.port, list):
@@ -191,6 +217,10 @@ class BaseMegaEntity(CoordinatorEntity, RestoreEntity):
         await super().async_added_to_hass()
         self._state = await self.async_get_last_state()
 
+    async def async_will_remove_from_hass(self) -> None:
+        await super().async_will_remove_from_hass()
+        self.mega.remove_entity(self)
+
     async def get_state(self):
         self.lg.debug(f'state is %s', self.state)
         self.async_write_ha_state()
@@ -283,7 +313,8 @@ class MegaOutPort(MegaPushEntity):
         self.is_extender = isinstance(self.port, str) and 'e' in self.port
         self.task: asyncio.Task = None
         self._restore_brightness = None
-        self._last_called: float = 0
+        # частые вызовы (движение слайдера) схлопываются до последнего, последнее состояние отправляется всегда
+        self._intents = IntentQueue()
 
     # @property
     # def assumed_state(self) -> bool:
@@ -311,70 +342,66 @@ class MegaOutPort(MegaPushEntity):
         ret = None
         if not self.dimmer:
             return
-        val = self.mega.values.get(self.port, {})
-        if isinstance(val, dict) and len(val) == 0 and self._state is not None:
+        state = self.mega.values.get(self.port)
+        if state is None and self._state is not None:
             ret = safe_int(self._state.attributes.get("brightness"), def_on=self.max_dim, def_off=0, def_val=0)
             ret = self._calc_brightness(ret)
-        elif isinstance(self.port, str) and 'e' in self.port:
-            if isinstance(val, str):
-                val = safe_int(val, def_on=self.max_dim, def_off=0, def_val=0)
-            else:
-                val = 0
+        elif self.is_extender:
+            val = 0
+            if state is not None:
+                val = safe_int(state.value, def_on=self.max_dim, def_off=0, def_val=0)
             if val == 0:
                 ret = self._brightness
-            elif isinstance(val, (int, float)):
+            else:
                 ret = int(val / self.dimmer_scale)
-        elif val is not None:
-            val = val.get("value")
-            if val is None:
+        elif state is not None:
+            if state.value is None:
                 return
-            try:
-                val = int(val)
-                ret = val
-            except Exception:
-                pass
+            if state.num is not None:
+                ret = int(state.num)
         ret = self._cal_reverse_brightness(ret)
         return ret
 
     @property
     def is_on(self) -> bool:
-        val = self.mega.values.get(self.port, {})
-        if isinstance(val, dict) and len(val) == 0 and self._state is not None:
-            return self._state == 'ON'
-        elif isinstance(self.port, str) and 'e' in self.port and val:
-            if val is None:
+        state = self.mega.values.get(self.port)
+        if state is None:
+            if self._state is not None:
+                return self._state.state == STATE_ON
+            return False
+        if self.is_extender:
+            if state.value is None:
                 return
             if self.dimmer:
-                val = safe_int(val)
-                if val is not None:
-                    return val > 0 if not self.invert else val == 0
-            else:
-                return val == 'ON' if not self.invert else val == 'OFF'
-        elif val is not None:
-            val = val.get("value")
-            if not isinstance(val, str) and self.index is not None and self.addr is not None:
-                if not isinstance(val, dict):
-                    self.mega.lg.warning(f'{self.entity_id}: {val} is not a dict')
-                    return
-                _val = val.get(self.addr, val.get(self.addr.lower(), val.get(self.addr.upper())))
-                if not isinstance(_val, str):
-                    self.mega.lg.warning(f'{self.entity_id}: can not get {self.addr} from {val}, recieved {_val}')
-                    return
-                _val = _val.split('/')
-                if len(_val) >= 2:
-                    self.mega.lg.debug('%s parsed values: %s[%s]="%s"', self.entity_id, _val, self.index, _val)
-                    val = _val[self.index]
-                else:
-                    self.mega.lg.warning(f'{self.entity_id}: {_val} has wrong length')
-                    return
-            elif self.index is not None and self.addr is None:
-                self.mega.lg.warning(f'{self.entity_id} does not has addr')
+                if state.num is not None:
+                    return state.num > 0 if not self.invert else state.num == 0
+                return
+            return state.value == 'ON' if not self.invert else state.value == 'OFF'
+        is_on = state.is_on
+        if self.index is not None and self.addr is not None and not isinstance(state.value, str):
+            val = state.value
+            if not isinstance(val, dict):
+                self.mega.lg.warning(f'{self.entity_id}: {val} is not a dict')
+                return
+            _val = val.get(self.addr, val.get(self.addr.lower(), val.get(self.addr.upper())))
+            if not isinstance(_val, str):
+                self.mega.lg.warning(f'{self.entity_id}: can not get {self.addr} from {val}, recieved {_val}')
                 return
-            self.mega.lg.debug('%s.state = %s', self.entity_id, val)
-            if not self.invert:
-                return val == 'ON' or str(val) == '1' or (safe_int(val) is not None and safe_int(val) > 0)
+            _val = _val.split('/')
+            if len(_val) >= 2:
+                self.mega.lg.debug('%s parsed values: %s[%s]="%s"', self.entity_id, _val, self.index, _val)
+                is_on = token_is_on(_val[self.index])
             else:
-                return val == 'OFF' or str(val) == '0' or (safe_int(val) is not None and safe_int(val) == 0)
+                self.mega.lg.warning(f'{self.entity_id}: {_val} has wrong length')
+                return
+        elif self.index is not None and self.addr is None:
+            self.mega.lg.warning(f'{self.entity_id} does not has addr')
+            return
+        self.mega.lg.debug('%s.state = %s', self.entity_id, state)
+        if not self.invert:
+            return is_on is True
+        else:
+            return is_on is False
 
     @property
     def cmd_port(self):
@@ -397,12 +424,7 @@ class MegaOutPort(MegaPushEntity):
         return self.smooth or self.can_smooth_hardware
 
     def update_from_smooth(self, value, update_state=False):
-        if isinstance(self.port, str):
-            self.mega.values[self.port] = value[0]
-        else:
-            self.mega.values[self.port] = {
-                'value': value[0]
-            }
+        self.mega.values.set(self.port, value[0], SOURCE_OPTIMISTIC)
         if update_state:
             self.async_write_ha_state()
 
@@ -442,10 +464,20 @@ class MegaOutPort(MegaPushEntity):
         brightness = round(pct * 255)
         return brightness
 
+    async def _send(self, cmd: dict):
+        if set(cmd) == {'cmd'}:
+            await self.mega.queue_command(cmd['cmd'])
+        else:
+            # команды с дополнительными параметрами (addr, pwm) в общую команду не склеиваются
+            await self.mega.request(**cmd, priority=PRIORITY_COMMAND)
+
     async def async_turn_on(self, brightness=None, transition=None, **kwargs):
-        if (time.time() - self._last_called) < 0.1:
-            return
-        self._last_called = time.time()
+        await self._intents.submit(partial(self._turn_on, brightness=brightness, transition=transition))
+
+    async def async_turn_off(self, transition=None, **kwargs) -> None:
+        await self._intents.submit(partial(self._turn_off, transition=transition))
+
+    async def _turn_on(self, brightness=None, transition=None):
         if not self.dimmer:
             transition = None
         if not self.is_on and (brightness is None or brightness == 0):
@@ -473,28 +505,17 @@ class MegaOutPort(MegaPushEntity):
         if self.addr:
             _cmd['addr'] = self.addr
         if not (self.smooth_dim or transition):
-            await self.mega.request(**_cmd, priority=-1)
+            await self._send(_cmd)
         if self.index is not None:
-            # обновление текущего стейта для ds2413
-            await self.mega.get_port(
-                port=self.port,
-                force_http=True,
-                conv=False,
-                http_cmd='list',
-            )
-        elif isinstance(self.port, str) and 'e' in self.port:
-            if not self.dimmer:
-                self.mega.values[self.port] = 'ON' if not self.invert else 'OFF'
-            else:
-                self.mega.values[self.port] = cmd
+            # ds2413: состояние проверяется при следующем опросе
+            self.mega.set_ds2413(self.port, self.addr, self.index, str(cmd) == '1')
+        elif self.is_extender and not self.dimmer:
+            self.mega.values.set(self.port, 'ON' if not self.invert else 'OFF', SOURCE_OPTIMISTIC)
         else:
-            self.mega.values[self.port] = {'value': cmd}
+            self.mega.values.set(self.port, cmd, SOURCE_OPTIMISTIC)
         await self.get_state()
 
-    async def async_turn_off(self, transition=None, **kwargs) -> None:
-        if (time.time() - self._last_called) < 0.1:
-            return
-        self._last_called = time.time()
+    async def _turn_off(self, transition=None):
         self._restore_brightness = self._cal_reverse_brightness(safe_int(self._brightness))
         if not self.dimmer:
             transition = None
@@ -504,7 +525,7 @@ class MegaOutPort(MegaPushEntity):
         if self.addr:
             _cmd['addr'] = self.addr
         if not (self.smooth_dim or transition):
-            await self.mega.request(**_cmd, priority=-1)
+            await self._send(_cmd)
         else:
             self._set_dim_brightness(
                 from_=_prev,
@@ -512,20 +533,17 @@ class MegaOutPort(MegaPushEntity):
                 transition=transition,
             )
         if self.index is not None:
-            # обновление текущего стейта для ds2413
-            await self.mega.get_port(
-                port=self.port,
-                force_http=True,
-                conv=False,
-                http_cmd='list',
-            )
-        elif isinstance(self.port, str) and 'e' in self.port:
-            self.mega.values[self.port] = 'OFF' if not self.invert else 'ON'
+            # ds2413: состояние проверяется при следующем опросе
+            self.mega.set_ds2413(self.port, self.addr, self.index, str(cmd) == '1')
+        elif self.is_extender:
+            self.mega.values.set(self.port, 'OFF' if not self.invert else 'ON', SOURCE_OPTIMISTIC)
         else:
-            self.mega.values[self.port] = {'value': cmd}
+            self.mega.values.set(self.port, cmd, SOURCE_OPTIMISTIC)
         await self.get_state()
 
     async def async_will_remove_from_hass(self) -> None:
+        await super().async_will_remove_from_hass()
+        self._intents.cancel()
         if self.task is not None:
             self.task.cancel()
 
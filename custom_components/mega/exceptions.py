@@ -1,3 +1,5 @@
+import asyncio
+
 from homeassistant import exceptions
 
 
@@ -14,4 +16,8 @@ class InvalidAuth(exceptions.HomeAssistantError):
 
 
 class NoPort(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class ControllerOffline(asyncio.TimeoutError):
+    """Controller is known to be offline, request was not sent"""
\ No newline at end of file
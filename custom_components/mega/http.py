@@ -12,6 +12,7 @@ from homeassistant.components.http import HomeAssistantView
 from homeassistant.core import HomeAssistant
 from .const import EVENT_BINARY_SENSOR, DOMAIN, CONF_RESPONSE_TEMPLATE
 from .tools import make_ints
+from .state import SOURCE_PUSH
 from . import hub as h
 _LOGGER = logging.getLogger(__name__).getChild('http')
 
@@ -34,7 +35,12 @@ class MegaView(HomeAssistantView):
         self.allowed_hosts = {'::1', '127.0.0.1'}
         self.notified_attempts = defaultdict(lambda : False)
         self.callbacks = defaultdict(lambda: defaultdict(list))
-        self.templates: typing.Dict[str, typing.Dict[str, Template]] = {
+        self.templates: typing.Dict[str, typing.Dict[str, Template]] = {}
+        self.update_templates(cfg)
+        self.hubs = {}
+
+    def update_templates(self, cfg: dict):
+        self.templates = {
             mid: {
                 pt: cfg[mid][pt][CONF_RESPONSE_TEMPLATE]
                 for pt in cfg[mid]
@@ -42,7 +48,6 @@ class MegaView(HomeAssistantView):
             } for mid in cfg if isinstance(cfg[mid], dict)
         }
         _LOGGER.debug('templates: %s', self.templates)
-        self.hubs = {}
 
     async def get(self, request: Request) -> Response:
         _LOGGER.debug('request from %s %s', request.remote, request.headers)
@@ -103,6 +108,7 @@ class MegaView(HomeAssistantView):
         data['mega_id'] = hub.id
         ret = 'd' if hub.force_d else ''
         if port is not None:
+            touched = []
             if is_ext(data):
                 # ret = ''  # пока ответ всегда пустой, неясно какая будет реакция на непустой ответ
                 if port in hub.extenders:
@@ -121,7 +127,8 @@ class MegaView(HomeAssistantView):
                         _data['pt_orig'] = pt_orig
                         _data['value'] = 'ON' if v == '1' else 'OFF'
                         _data['m'] = 1 if _data[e] == '0' else 0  # имитация поведения обычного входа, чтобы события обрабатывались аналогично
-                        hub.values[pt] = _data
+                        hub.values.set(pt, _data, SOURCE_PUSH)
+                        touched.append(pt)
                         for cb in self.callbacks[hub.id][pt]:
                             cb(_data)
                         act = hub.ext_act.get(pt)
@@ -136,7 +143,8 @@ class MegaView(HomeAssistantView):
                         ret = 'd' if hub.force_d else ''
             else:
             # elif port in hub.binary_sensors:
-                hub.values[port] = data
+                hub.values.set(port, data, SOURCE_PUSH)
+                touched.append(port)
                 for cb in self.callbacks[hub.id][port]:
                     cb(data)
                 template: Template = self.templates.get(hub.id, {}).get(port, hub.def_response)
@@ -144,7 +152,8 @@ class MegaView(HomeAssistantView):
                     template.hass = hass
                     ret = template.async_render(data)
             if hub.update_all and update_all:
-                asyncio.create_task(self.later_update(hub))
+                # ответ сервера - это тоже команда контроллеру, ее порты так же нужно обновить
+                hub.request_refresh(*touched, cmd=ret if isinstance(ret, str) and ret != 'd' else None)
         _LOGGER.debug('response %s', ret)
         Response(body='' if hub.fake_response else ret, content_type='text/plain')
 
@@ -166,8 +175,3 @@ class MegaView(HomeAssistantView):
         if hub.restore_on_restart:
             await hub.restore_states()
         await hub.reload()
-
-    async def later_update(self, hub):
-        await asyncio.sleep(1)
-        _LOGGER.debug('force update')
-        await hub.updater.async_refresh()
\ No newline at end of file
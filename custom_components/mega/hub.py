@@ -1,6 +1,9 @@
 import asyncio
 import logging
+import time
 from collections import defaultdict
+from contextvars import ContextVar
+from functools import partial
 from datetime import datetime, timedelta
 
 import aiohttp
@@ -15,6 +18,8 @@ from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import TEMP_CELSIUS, PERCENTAGE, LIGHT_LUX
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
+from .dimmer import DimmingEngine
+from .discovery import get_discovery_cache, page_hash
 from .config_parser import parse_config, DS2413, MCP230, MCP230_OUT, MCP230_IN, PCA9685
 from .const import (
     TEMP,
@@ -25,17 +30,44 @@ from .const import (
     DOMAIN,
     CONF_HTTP,
     EVENT_BINARY_SENSOR,
+    EVENT_DS2413_MISMATCH,
     CONF_CUSTOM,
     CONF_FORCE_D,
     CONF_DEF_RESPONSE,
     PATT_FW,
+    PATT_ACT_PORT,
+    PATT_PORT_CMD,
     CONF_FORCE_I2C_SCAN,
+    CONF_CONCURRENCY,
+    CONF_REFRESH_DELAY,
+    CONF_REFRESH_MAX_DELAY,
+    CONF_FULL_SYNC,
+    CONF_READ_FRESHNESS,
+    CONF_TRACE_POLL,
+    CMD_BATCH_WINDOW,
+    CMD_MAX_LEN,
+    PRIORITY_COMMAND,
+    PRIORITY_DEFAULT,
+    PRIORITY_POLL,
     REMOVE_CONFIG,
 )
 from .entities import set_events_off, BaseMegaEntity, MegaOutPort, safe_int
-from .exceptions import CannotConnect, NoPort
+from .exceptions import CannotConnect, NoPort, ControllerOffline
+from .metrics import HubMetrics, request_kind
 from .i2c import parse_scan_page
-from .tools import make_ints, int_ignore, PriorityLock
+from .tracing import PollTracer
+from .state import StateStore, SOURCE_POLL, SOURCE_PUSH, SOURCE_OPTIMISTIC, token_is_on
+from .tools import (
+    make_ints,
+    int_ignore,
+    Debouncer,
+    CommandBatcher,
+    RequestScheduler,
+    StaleRequest,
+    RttTracker,
+    CircuitBreaker,
+    backoff_delay,
+)
 
 TEMP_PATT = re.compile(r"temp:([01234567890\.]+)")
 HUM_PATT = re.compile(r"hum:([01234567890\.]+)")
@@ -49,6 +81,20 @@ CLASSES = {
     PRESS: SensorDeviceClass.PRESSURE,
     LUX: SensorDeviceClass.ILLUMINANCE,
 }
+W1_CONV_TIME = 1  # время конвертации 1-wire датчиков, сек
+W1_BUSY_TRIES = 3
+REQUEST_TRIES = 3
+# таймаут запросов, пока не накоплена статистика времени ответа, и для долгих запросов (cmd=scan)
+REQUEST_TIMEOUT = 5
+# интервал проверки связи с контроллером, который перестал отвечать: от 1 до 30 секунд
+PROBE_MIN_INTERVAL = 1
+PROBE_MAX_INTERVAL = 30
+# сколько раз подряд контроллер должен оборвать переиспользуемое соединение, чтобы отказаться от keep-alive
+KEEP_ALIVE_DROPS = 3
+# команды чтения, одинаковые запросы в очереди склеиваются
+READ_CMDS = ("all", "get", "list")
+# срок годности запросов текущего цикла опроса, наследуется всеми задачами цикла
+_POLL_DEADLINE: ContextVar[typing.Optional[float]] = ContextVar("mega_poll_deadline", default=None)
 I2C_DEVICE_TYPES = {
     "2": LUX,  # BH1750
     "3": LUX,  # TSL2591
@@ -83,6 +129,7 @@ class MegaD:
         extenders=None,
         ext_in=None,
         ext_acts=None,
+        acts=None,
         i2c_sensors=None,
         new_naming=False,
         update_time=False,
@@ -107,6 +154,7 @@ class MegaD:
         self.extenders = extenders or []
         self.ext_in = ext_in or {}
         self.ext_act = ext_acts or {}
+        self.acts = {int_ignore(k): v for k, v in (acts or {}).items()}
         self.i2c_sensors = i2c_sensors or []
         self._update_time = update_time
         self.poll_outs = poll_outs
@@ -120,12 +168,24 @@ class MegaD:
         self.id = id
         self.lck = asyncio.Lock()
         self.last_long = {}
-        self._http_lck = PriorityLock()
         self._notif_lck = asyncio.Lock()
         self.cnd = asyncio.Condition()
         self.online = True
         self.entities: typing.List[BaseMegaEntity] = []
+        # индекс ключ values (порт) -> объекты, которые от него зависят
+        self._port_index: typing.DefaultDict[
+            typing.Any, typing.List[BaseMegaEntity]
+        ] = defaultdict(list)
+        self._unsub_dispatch = None
         self.ds2413_ports = set()
+        # ожидаемые после команд состояния каналов ds2413: (port, addr, index) -> (вкл, время команды),
+        # проверяются при следующем чтении порта
+        self._ds2413_expected: typing.Dict[tuple, typing.Tuple[bool, float]] = {}
+        self.ds2413_stats = {
+            "optimistic": 0,
+            "verified": 0,
+            "mismatch": 0,
+        }
         self.poll_interval = scan_interval
         self.subs = None
         self.lg: logging.Logger = lg.getChild(self.id)
@@ -138,7 +198,14 @@ class MegaD:
         ] = defaultdict(list)
         self._loop = loop
         self._customize = None
-        self.values = {}
+        self.values = StateStore()
+        # последний ответ cmd=all по портам (токен и время разбора), чтобы не разбирать неизменные порты
+        self._all_raw: typing.List[typing.Optional[typing.Tuple[str, float]]] = []
+        # порты, значения которых изменились с последней раздачи обновления, только их объекты обновляют свое
+        # состояние. Раз в full_sync циклов (и после ошибок опроса) обновляются все объекты
+        self.changed_ports = set()
+        self.full_sync = True
+        self._force_sync = False
         self.last_port = None
         self.updater = DataUpdateCoordinator(
             hass,
@@ -158,8 +225,53 @@ class MegaD:
         else:
             self.mqtt_id = mqtt_id
         self.restore_on_restart = restore_on_restart
+        # настройки записи интеграции накладываются поверх yaml и переживают перезагрузку yaml
+        self._entry_customize = {}
         if force_d is not None:
-            self.customize[CONF_FORCE_D] = force_d
+            self._entry_customize[CONF_FORCE_D] = force_d
+        # контроллер однопоточный, поэтому кол-во одновременных запросов ограничено
+        self.concurrency = self.customize.get(CONF_CONCURRENCY, 1)
+        self.metrics = HubMetrics()
+        self.scheduler = RequestScheduler(
+            concurrency=self.concurrency, on_wait=self.metrics.wait
+        )
+        # одинаковые чтения, выполняемые одновременно, отправляются один раз (single-flight): к уже отправленному
+        # запросу присоединяются, одинаковые запросы в очереди объединяет self.scheduler. Ответ можно
+        # переиспользовать в течение read_freshness секунд
+        self.read_freshness = self.customize.get(CONF_READ_FRESHNESS, 0)
+        self._inflight: typing.Dict[str, asyncio.Future] = {}
+        self._fresh: typing.Dict[str, typing.Tuple[float, str]] = {}
+        self.read_stats = {
+            "shared": 0,
+            "fresh": 0,
+        }
+        # таймаут запросов подстраивается под время ответа контроллера, после нескольких неудачных запросов
+        # подряд контроллер считается недоступным: запросы не отправляются, пока не ответит проверочный запрос
+        self.rtt = RttTracker(max_timeout=REQUEST_TIMEOUT)
+        self.breaker = CircuitBreaker(threshold=REQUEST_TRIES)
+        self._probe_task: typing.Optional[asyncio.Task] = None
+        # дерево фаз последних циклов опроса для диагностики, по умолчанию выключено
+        self.tracer = PollTracer(size=self.customize.get(CONF_TRACE_POLL, 0))
+        # обновления после событий от контроллера склеиваются в один опрос
+        self._refresh_ports = set()
+        self._refresh_cmds = []
+        self._refresh_all = False
+        self.refresher = Debouncer(
+            self._refresh_pending,
+            quiet=self.customize.get(CONF_REFRESH_DELAY, 1),
+            max_latency=self.customize.get(CONF_REFRESH_MAX_DELAY, 3),
+        )
+        self.full_sync_cycles = self.customize.get(CONF_FULL_SYNC, 10)
+        self.dimmer = DimmingEngine(self)
+        self.commands = CommandBatcher(
+            self._send_commands, window=CMD_BATCH_WINDOW, max_len=CMD_MAX_LEN
+        )
+        self.poll_stats = {
+            "cycles": 0,
+            "last": None,
+            "max": None,
+            "stale": 0,
+        }
         try:
             if allow_hosts is not None and DOMAIN in hass.data:
                 allow_hosts = set(allow_hosts.split(";"))
@@ -167,43 +279,328 @@ class MegaD:
             hass.data[DOMAIN][CONF_HTTP].protected = protected
         except Exception:
             self.lg.exception("while setting allowed hosts")
-        self.binary_sensors = []
+        self.binary_sensors = set()
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+        self._keep_alive = True
+        self._reuse_drops = 0
+        # кол-во выполняемых запросов по сессиям: сессия, замененная при отказе от keep-alive, закрывается
+        # только после завершения всех ее запросов
+        self._session_refs: typing.Dict[aiohttp.ClientSession, int] = defaultdict(int)
+        self._retired_sessions: typing.Set[aiohttp.ClientSession] = set()
+        self.conn_stats = {
+            "requests": 0,
+            "created": 0,
+            "reused": 0,
+            "keep_alive": True,
+        }
 
     async def start(self):
-        pass
+        # сессия создается заранее, чтобы первый опрос не тратил время на ее инициализацию
+        _ = self.session
+        if self._unsub_dispatch is None:
+            self._unsub_dispatch = self.updater.async_add_listener(self._dispatch_update)
 
     async def stop(self):
+        self.refresher.cancel()
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        self.dimmer.stop()
+        self.commands.cancel()
+        if self._unsub_dispatch is not None:
+            self._unsub_dispatch()
+            self._unsub_dispatch = None
         if self.subs is not None:
             self.subs()
         for x in self._callbacks.values():
             x.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Долгоживущая сессия хаба, все запросы к контроллеру идут через нее, соединение по возможности
+        переиспользуется (keep-alive)
+        """
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_conn_created)
+            trace.on_connection_reuseconn.append(self._on_conn_reused)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.concurrency,
+                    force_close=not self._keep_alive,
+                ),
+                trace_configs=[trace],
+            )
+        return self._session
+
+    async def _on_conn_created(self, session, ctx, params):
+        self.conn_stats["created"] += 1
+
+    async def _on_conn_reused(self, session, ctx, params):
+        self.conn_stats["reused"] += 1
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx["reused"] = True
+
+    async def _disable_keep_alive(self):
+        """
+        Прошивка рвет переиспользуемые соединения, переходим на режим соединение-на-запрос
+        """
+        self.lg.info("controller drops keep-alive connections, fallback to connection per request")
+        self._keep_alive = False
+        self.conn_stats["keep_alive"] = False
+        session, self._session = self._session, None
+        if session is None:
+            return
+        if self._session_refs.get(session):
+            self._retired_sessions.add(session)
+        else:
+            await session.close()
 
-    async def add_entity(self, ent):
-        async with self.lck:
-            self.entities.append(ent)
+    async def _get(self, url, timeout: aiohttp.ClientTimeout = None):
+        """
+        GET-запрос к контроллеру через сессию хаба. Если контроллер оборвал переиспользуемое соединение, запрос
+        повторяется по новому соединению
+        :return: (status, text)
+        """
+        ctx = {"reused": False}
+        try:
+            ret = await self._session_get(self.session, url, timeout, ctx)
+        except aiohttp.ServerDisconnectedError:
+            if not ctx["reused"]:
+                # оборвано новое соединение: контроллер перезагружается или недоступен
+                raise
+        else:
+            if ctx["reused"]:
+                self._reuse_drops = 0
+            return ret
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(force_close=True)
+        ) as session:
+            ret = await self._session_get(session, url, timeout)
+        # по новому соединению контроллер ответил, значит обрывы связаны с keep-alive
+        self._reuse_drops += 1
+        if self._keep_alive and self._reuse_drops >= KEEP_ALIVE_DROPS:
+            await self._disable_keep_alive()
+        return ret
+
+    async def _session_get(self, session, url, timeout, ctx: dict = None):
+        self._session_refs[session] += 1
+        try:
+            async with session.get(url, timeout=timeout, trace_request_ctx=ctx) as req:
+                self.conn_stats["requests"] += 1
+                return req.status, await req.text(encoding="iso-8859-5")
+        finally:
+            self._session_refs[session] -= 1
+            if not self._session_refs[session]:
+                del self._session_refs[session]
+                if session in self._retired_sessions:
+                    # сессия заменена при отказе от keep-alive, ее последний запрос завершен
+                    self._retired_sessions.discard(session)
+                    await session.close()
+
+    def add_entity(self, ent: BaseMegaEntity):
+        self.entities.append(ent)
+        for x in ent.state_keys:
+            self._port_index[x].append(ent)
+
+    def remove_entity(self, ent: BaseMegaEntity):
+        try:
+            self.entities.remove(ent)
+        except ValueError:
+            return
+        for x in ent.state_keys:
+            subs = self._port_index.get(x)
+            if subs is None:
+                continue
+            if ent in subs:
+                subs.remove(ent)
+            if not subs:
+                del self._port_index[x]
+
+    def get_entities(self, port) -> typing.List[BaseMegaEntity]:
+        return self._port_index.get(port, [])
+
+    def _dispatch_update(self):
+        """
+        Раздача обновления координатора: состояние пишут только объекты, чьи порты изменились за опрос
+        (или все, если это цикл полной синхронизации)
+        """
+        if self.full_sync:
+            targets = self.entities
+        else:
+            targets = {}
+            for x in self.changed_ports:
+                for ent in self.get_entities(x):
+                    targets[id(ent)] = ent
+            targets = targets.values()
+        self.changed_ports = set()
+        self.full_sync = False
+        self._write_states(targets)
+
+    @staticmethod
+    def _write_states(targets):
+        for ent in targets:
+            if ent.hass is not None:
+                ent.async_write_ha_state()
 
     async def get_sensors(self, only_list=False):
+        started = time.monotonic()
+        self._commit_values(await self._read_sensors(only_list=only_list), started)
+
+    async def _read_sensors(self, only_list=False):
         self.lg.debug(self.sensors)
-        ports = []
+        ret = {}
+        bus = []
         for x in self.sensors:
-            if only_list and x.http_cmd != "list":
+            if x.http_cmd == "list":
+                if x.port not in bus:
+                    bus.append(x.port)
                 continue
-            if x.port in ports:
+            if only_list or x.port in ret:
                 continue
             try:
-                await self.get_port(x.port, force_http=True, http_cmd=x.http_cmd)
+                ret[x.port] = await self._read_port(x.port, http_cmd=x.http_cmd)
             except asyncio.TimeoutError:
                 continue
-            ports.append(x.port)
+        if bus:
+            with self.tracer.span("1wire", ports=bus):
+                ret.update(await self._read_1w_bus(bus))
+        return ret
+
+    async def _read_1w_bus(self, ports: typing.List[int]):
+        """
+        Опрос шин 1-wire: команда conv отправляется сразу на все шины, затем одно общее ожидание конвертации и
+        чтение всех шин. Повторно опрашиваются только шины, ответившие busy
+        :param ports: порты шин
+        :return: новые значения портов
+        """
+        ret = {}
+        if not ports:
+            return ret
+        conv = await asyncio.gather(
+            *[self.request(pt=x, cmd="conv") for x in ports], return_exceptions=True
+        )
+        ports = [x for x, r in zip(ports, conv) if not isinstance(r, asyncio.TimeoutError)]
+        await asyncio.sleep(W1_CONV_TIME)
+        for ntry in range(W1_BUSY_TRIES + 1):
+            if ntry:
+                self.lg.debug("1-wire ports %s are busy, retry", ports)
+                await asyncio.sleep(W1_CONV_TIME)
+            data = await asyncio.gather(
+                *[self.request(pt=x, cmd="list") for x in ports], return_exceptions=True
+            )
+            busy = []
+            for port, x in zip(ports, data):
+                if isinstance(x, asyncio.TimeoutError):
+                    continue
+                elif isinstance(x, BaseException):
+                    raise x
+                ret[port] = self.parse_response(x, cmd="list")
+                if ret[port] is None:
+                    busy.append(port)
+            if not busy:
+                break
+            ports = busy
+        return ret
+
+    def request_refresh(self, *ports, cmd=None):
+        """
+        Запрос на обновление состояний после события, частые запросы склеиваются в один опрос
+        :param ports: порты, на которых произошло событие. Если указаны, обновляются только выходы, которые
+            затрагивает сценарий (act) этих портов, иначе выполняется полный опрос
+        :param cmd: команда, отправленная контроллеру в ответ на событие
+        """
+        if ports:
+            self._refresh_ports.update(ports)
+            if cmd:
+                self._refresh_cmds.append(cmd)
+        else:
+            self._refresh_all = True
+        self.refresher.request()
+
+    async def _refresh_pending(self):
+        ports, cmds, full = self._refresh_ports, self._refresh_cmds, self._refresh_all
+        self._refresh_ports, self._refresh_cmds, self._refresh_all = set(), [], False
+        if full:
+            await self.updater.async_refresh()
+        else:
+            await self.refresh_ports(ports, cmds)
+
+    def _act_targets(self, ports, cmds=()) -> typing.Tuple[set, set]:
+        """
+        Расширители и порты ds2413, которые могут измениться после срабатывания портов
+        :return: (extenders, ds2413_ports)
+        """
+        extenders, ds2413 = set(), set()
+        acts = list(cmds)
+        for port in ports:
+            act = self.ext_act.get(port) if isinstance(port, str) else self.acts.get(port)
+            if not act:
+                # сценарий неизвестен (например, конфиг записан до того, как сценарии стали сохраняться), на всякий
+                # случай обновляем все расширители и ds2413
+                extenders.update(self.extenders)
+                ds2413.update(self.ds2413_ports)
+                continue
+            acts.append(act)
+        for act in acts:
+            for pt, ext, ab in PATT_ACT_PORT.findall(act):
+                pt = int(pt)
+                if ext and pt in self.extenders:
+                    extenders.add(pt)
+                elif ab and pt in self.ds2413_ports:
+                    ds2413.add(pt)
+        return extenders, ds2413
+
+    async def refresh_ports(self, ports, cmds=()):
+        """
+        Частичное обновление после срабатывания портов: состояние портов (cmd=all) и только те расширители и
+        ds2413, на которые ссылаются сценарии портов. i2c, 1-wire и прочие датчики не опрашиваются
+        :param ports: сработавшие порты
+        :param cmds: дополнительные команды, отправленные контроллеру
+        """
+        started = time.monotonic()
+        extenders, ds2413 = self._act_targets(ports, cmds)
+        self.lg.debug("partial refresh of %s: extenders %s, ds2413 %s", ports, extenders, ds2413)
+
+        async def _ds2413(x):
+            return {x: await self._read_port(x, http_cmd="list", conv=False)}
+
+        plan = [self._read_all_ports()]
+        plan.extend(self._poll_extender(x) for x in extenders)
+        plan.extend(_ds2413(x) for x in ds2413)
+        results = await asyncio.gather(*plan, return_exceptions=True)
+        new = {}
+        for ret in results:
+            if isinstance(ret, asyncio.TimeoutError):
+                continue
+            elif isinstance(ret, BaseException):
+                raise ret
+            new.update(ret)
+        self._commit_values(new, started)
+        self.updater.async_update_listeners()
 
     @property
     def customize(self):
         if self._customize is None:
             c = self.hass.data.get(DOMAIN, {}).get(CONF_CUSTOM) or {}
             c = c.get(self.id) or {}
-            self._customize = c
+            self._customize = {**c, **self._entry_customize} if self._entry_customize else c
         return self._customize
 
+    def invalidate_customize(self):
+        """
+        Сброс закешированной кастомизации хаба и его объектов, вызывается после перезагрузки yaml
+        """
+        self._customize = None
+        for ent in self.entities:
+            ent.invalidate_customize()
+            if ent.hass is not None:
+                ent.async_write_ha_state()
+
     @property
     def force_d(self):
         return self.customize.get(CONF_FORCE_D, False)
@@ -238,90 +635,387 @@ class MegaD:
     async def _get_ds2413(self):
         """
         обновление ds2413 устройств
-        :return:
+        :return: новые значения портов
         """
+        ret = {}
         for x in self.ds2413_ports:
             self.lg.debug(f"poll ds2413 for %s", x)
             try:
-                await self.get_port(
-                    port=x, force_http=True, http_cmd="list", conv=False
-                )
+                ret[x] = await self._read_port(port=x, http_cmd="list", conv=False)
             except asyncio.TimeoutError:
                 continue
+        return ret
 
-    async def poll(self):
+    @staticmethod
+    def _ds2413_key(value: dict, addr: str):
+        for x in (addr, addr.lower(), addr.upper()):
+            if x in value:
+                return x
+
+    def set_ds2413(self, port, addr: str, index: int, is_on: bool):
         """
-        Polling ports
+        Оптимистичное обновление канала ds2413 после команды, без повторного чтения порта. Реальное состояние
+        проверяется при следующем опросе ds2413 (см. _verify_ds2413)
         """
-        self.lg.debug("poll")
-        if self._update_time:
-            await self.update_time()
+        state = self.values.get(port)
+        key = None
+        if state is not None and isinstance(state.value, dict):
+            key = self._ds2413_key(state.value, addr)
+        tokens = state.value[key].split("/") if key is not None else []
+        if len(tokens) < 2 or index >= len(tokens):
+            # текущее состояние неизвестно, второй канал не из чего взять
+            self.request_refresh()
+            return
+        tokens[index] = "ON" if is_on else "OFF"
+        value = dict(state.value)
+        value[key] = "/".join(tokens)
+        self.values.set(port, value, SOURCE_OPTIMISTIC)
+        self.ds2413_stats["optimistic"] += 1
+        self._ds2413_expected[(port, addr.lower(), index)] = (is_on, time.monotonic())
+
+    def _verify_ds2413(self, values: dict, started: float):
+        """
+        Сравнение прочитанных состояний ds2413 с ожидаемыми после команд. Проверяются только чтения, начатые после
+        команды. При расхождении отправляется событие mega.ds2413_mismatch
+        :param started: время начала чтения values
+        """
+        for (port, addr, index), (expected, ts) in list(self._ds2413_expected.items()):
+            if port not in values or ts > started:
+                continue
+            del self._ds2413_expected[(port, addr, index)]
+            value = values[port]
+            if isinstance(value, dict) and "value" in value:
+                value = value["value"]
+            key = self._ds2413_key(value, addr) if isinstance(value, dict) else None
+            tokens = value[key].split("/") if key is not None else []
+            actual = token_is_on(tokens[index]) if index < len(tokens) else None
+            if actual == expected:
+                self.ds2413_stats["verified"] += 1
+                continue
+            self.ds2413_stats["mismatch"] += 1
+            self.lg.warning(
+                "ds2413 %s %s[%s] expected %s, read %s", port, addr, index, expected, actual
+            )
+            self.hass.bus.async_fire(
+                EVENT_DS2413_MISMATCH,
+                {
+                    "mega_id": self.id,
+                    "port": port,
+                    "addr": addr,
+                    "index": index,
+                    "expected": expected,
+                    "actual": actual,
+                },
+            )
+
+    def _i2c_chains(self) -> typing.List[typing.List[dict]]:
+        """
+        Группировка i2c-запросов по устройствам. Внутри одного устройства запросы выполняются строго по порядку
+        (после запроса с delay устройству нужно время на измерение), разные устройства опрашиваются независимо
+        """
+        chains = defaultdict(list)
         for x in self.i2c_sensors:
             if not isinstance(x, dict):
                 continue
-            ret = await self._update_i2c(x)
-            if isinstance(ret, dict):
-                self.values.update(ret)
+            chains[(x.get("pt"), x.get("i2c_dev"), x.get("addr"))].append(x)
+        return list(chains.values())
+
+    async def _poll_i2c(self, chain: typing.List[dict]):
+        """
+        Опрос одного i2c-устройства. Пока устройство выполняет измерение (delay), соединение с контроллером
+        свободно для других запросов цикла опроса
+        """
+        ret = {}
+        for i, x in enumerate(chain):
+            _ret = await self._update_i2c(x, wait=i < len(chain) - 1)
+            if isinstance(_ret, dict):
+                ret.update(_ret)
+        return ret
 
+    async def _poll_extender(self, port):
+        ret = await self._update_extender(port)
+        if not isinstance(ret, dict):
+            self.lg.warning(f"wrong updater result: {ret} from extender {port}")
+            return {}
+        return ret
+
+    def _plan_poll(self) -> typing.List[typing.Coroutine]:
+        """
+        Планирование цикла опроса: список независимых групп запросов, каждая группа возвращает словарь новых
+        значений. Порядок групп важен: при совпадении портов побеждает более поздняя группа
+        """
+        trace = self.tracer.wrap
+        plan = []
+        for x in self._i2c_chains():
+            pt, dev, addr = x[0].get("pt"), x[0].get("i2c_dev"), x[0].get("addr")
+            plan.append(trace("i2c", self._poll_i2c(x), pt=pt, dev=dev, addr=addr))
         for x in self.extenders:
-            ret = await self._update_extender(x)
-            if not isinstance(ret, dict):
-                self.lg.warning(f"wrong updater result: {ret} from extender {x}")
-                continue
-            self.values.update(ret)
+            plan.append(trace("extender", self._poll_extender(x), pt=x))
+        plan.append(trace("get_all_ports", self._read_all_ports()))
+        plan.append(trace("get_sensors", self._read_sensors(only_list=True)))
+        if self.ds2413_ports:
+            plan.append(trace("get_ds2413", self._get_ds2413()))
+        return plan
+
+    def _commit_values(self, values: dict, started: float, full_sync=False):
+        """
+        Сохранение результатов опроса в центральное хранилище values, изменившиеся порты запоминаются в
+        changed_ports до следующей раздачи обновления
+        :param started: время начала чтения values (time.monotonic()), опрос и обновление по событию могут
+            выполняться одновременно, поэтому время передается каждым циклом свое
+        :param full_sync: после этого цикла обновить все объекты
+        """
+        if self._ds2413_expected:
+            self._verify_ds2413(values, started)
+        self.changed_ports |= self.values.update(values, SOURCE_POLL, started=started)
+        if full_sync:
+            self.full_sync = True
 
-        await self.get_all_ports()
-        await self.get_sensors(only_list=True)
-        await self._get_ds2413()
+    async def poll(self):
+        """
+        Polling ports
+
+        Независимые группы запросов выполняются параллельно, кол-во одновременных запросов к контроллеру
+        ограничено self.concurrency. Все результаты записываются в values одним шагом после завершения цикла.
+        """
+        self.lg.debug("poll")
+        started = time.monotonic()
+        full_sync = (
+            not self.full_sync_cycles
+            or self.poll_stats["cycles"] % self.full_sync_cycles == 0
+            or self._force_sync
+        )
+        self._force_sync = False
+        # запросы опроса, которые простояли в очереди до начала следующего цикла, не выполняются
+        token = _POLL_DEADLINE.set(
+            started + self.poll_interval if self.poll_interval else None
+        )
+        try:
+            with self.tracer.cycle("poll", full_sync=full_sync):
+                if self._update_time:
+                    with self.tracer.span("update_time"):
+                        await self.update_time()
+                results = await asyncio.gather(*self._plan_poll(), return_exceptions=True)
+            new = {}
+            for ret in results:
+                if isinstance(ret, StaleRequest):
+                    self.poll_stats["stale"] += 1
+                    continue
+                if isinstance(ret, BaseException):
+                    raise ret
+                new.update(ret)
+        except BaseException:
+            # при ошибке обновляем все объекты, и в следующем успешном цикле тоже
+            self.full_sync = self._force_sync = True
+            raise
+        finally:
+            _POLL_DEADLINE.reset(token)
+        self._commit_values(new, started, full_sync=full_sync)
+        self._report_poll(time.monotonic() - started)
         return self.values
 
+    def _report_poll(self, duration: float):
+        stats = self.poll_stats
+        stats["cycles"] += 1
+        stats["last"] = duration
+        stats["max"] = max(stats["max"] or 0, duration)
+        self.lg.debug("poll cycle took %.2fs", duration)
+        if self.poll_interval and duration > self.poll_interval:
+            self.lg.warning(
+                "poll cycle took %.1fs, which is longer than scan_interval (%ss)",
+                duration,
+                self.poll_interval,
+            )
+
     async def get_mqtt_id(self):
-        async with aiohttp.request(
-            "get", f"http://{self.host}/{self.sec}/?cf=2"
-        ) as req:
-            data = await req.text(encoding="iso-8859-5")
-            data = BeautifulSoup(data, features="lxml")
-            _id = data.find(attrs={"name": "mdid"})
-            if _id:
-                _id = _id["value"]
-            return _id or "megad/" + self.host.split(".")[-1]
+        _, data = await self._get(f"http://{self.host}/{self.sec}/?cf=2")
+        data = BeautifulSoup(data, features="lxml")
+        _id = data.find(attrs={"name": "mdid"})
+        if _id:
+            _id = _id["value"]
+        return _id or "megad/" + self.host.split(".")[-1]
 
     async def get_fw(self):
         data = await self.request()
         return PATT_FW.search(data).groups()[0]
 
     async def send_command(self, port=None, cmd=None):
+        if port is None and cmd is not None and PATT_PORT_CMD.match(str(cmd)):
+            # команды вида pt:v склеиваются с командами других объектов
+            return await self.queue_command(str(cmd))
         return await self.request(pt=port, cmd=cmd)
 
-    async def request(self, priority=0, **kwargs):
-        cmd = "&".join([f"{k}={v}" for k, v in kwargs.items() if v is not None])
+    @staticmethod
+    def _is_read(params: dict) -> bool:
+        """
+        Запрос только читает состояние контроллера (страница порта, cmd=all/get/list)
+        """
+        cmd = params.get("cmd")
+        if cmd is None:
+            return set(params) <= {"pt", "ext"}
+        return cmd in READ_CMDS and set(params) <= {"pt", "cmd"}
+
+    async def request(self, priority=None, deadline=None, timeout=None, **kwargs):
+        """
+        Запрос к контроллеру через очередь хаба self.scheduler
+
+        :param priority: приоритет в очереди (PRIORITY_COMMAND, PRIORITY_DEFAULT, PRIORITY_POLL), внутри цикла
+            опроса по умолчанию PRIORITY_POLL
+        :param deadline: time.monotonic(), после которого запрос из очереди не выполняется (StaleRequest), внутри
+            цикла опроса по умолчанию - начало следующего цикла
+        :param timeout: таймаут одной попытки, по умолчанию рассчитывается по времени ответа контроллера
+        """
+        params = {k: v for k, v in kwargs.items() if v is not None}
+        cmd = "&".join([f"{k}={v}" for k, v in params.items()])
         url = f"http://{self.host}/{self.sec}"
         if cmd:
             url = f"{url}/?{cmd}"
+        kind = request_kind(params)
+        poll_deadline = _POLL_DEADLINE.get()
+        if priority is None:
+            priority = PRIORITY_POLL if poll_deadline is not None else PRIORITY_DEFAULT
+        if deadline is None and priority == PRIORITY_POLL:
+            deadline = poll_deadline
+        if not self._is_read(params):
+            # команда могла изменить состояние, сохраненные ответы больше не годятся
+            self._fresh.clear()
+            return await self._request(url, priority, deadline, kind, timeout=timeout)
+        if self.read_freshness:
+            cached = self._fresh.get(url)
+            if cached is not None and time.monotonic() - cached[0] <= self.read_freshness:
+                self.read_stats["fresh"] += 1
+                return cached[1]
+        fut = self._inflight.get(url)
+        if fut is not None:
+            # запрос уже отправлен, его приоритет и срок больше не важны. Если он не удался, выполняем свой
+            # запрос со своими приоритетом и сроком
+            self.read_stats["shared"] += 1
+            try:
+                return self._response(url, *await asyncio.shield(fut))
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                pass
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+        # одинаковые запросы, которые еще ждут в очереди, объединяются по ключу url: общий запрос получает
+        # наивысший приоритет и самый поздний срок
+        return await self._request(url, priority, deadline, kind, key=url, timeout=timeout)
+
+    async def _shared_get(self, url, timeout: float, kind: str):
+        """
+        Выполнение чтения, к которому могут присоединиться другие такие же чтения
+        """
+        fut = self._inflight[url] = asyncio.get_event_loop().create_future()
+        try:
+            ret = await self._timed_get(url, timeout, kind)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as exc:
+            fut.set_exception(exc)
+            # ошибка может быть никому не нужна, если никто не присоединился
+            fut.exception()
+            raise
+        finally:
+            if self._inflight.get(url) is fut:
+                del self._inflight[url]
+        fut.set_result(ret)
+        if self.read_freshness and ret[0] == 200:
+            self._fresh[url] = (time.monotonic(), ret[1])
+        return ret
+
+    async def _timed_get(self, url, timeout: float, kind: str = "page"):
+        beg = time.monotonic()
+        ret = await self._get(url, timeout=aiohttp.ClientTimeout(total=timeout))
+        rtt = time.monotonic() - beg
+        self.rtt.add(rtt)
+        self.metrics.response(kind, rtt, len(ret[1]) if ret[1] else 0)
+        return ret
+
+    async def _request(self, url, priority, deadline, kind, key=None, timeout=None):
         self.lg.debug("request: %s", url)
-        async with self._http_lck(priority):
-            for _ntry in range(3):
-                try:
-                    async with aiohttp.request(
-                        "get", url=url, timeout=aiohttp.ClientTimeout(total=5)
-                    ) as req:
-                        if req.status != 200:
-                            self.lg.warning(
-                                "%s returned %s (%s)",
-                                url,
-                                req.status,
-                                await req.text(encoding="iso-8859-5"),
-                            )
-                            return None
-                        else:
-                            ret = await req.text(encoding="iso-8859-5")
-                            self.lg.debug("response %s", ret)
-                            return ret
-                except asyncio.TimeoutError:
-                    self.lg.warning(f"timeout while requesting {url}")
-                    # raise
-                    await asyncio.sleep(1)
-            raise asyncio.TimeoutError("after 3 tries")
+        with self.tracer.span("request", kind=kind) as span:
+            return await self._request_tries(url, priority, deadline, kind, key, timeout, span)
+
+    async def _request_tries(self, url, priority, deadline, kind, key, timeout, span):
+        for _ntry in range(REQUEST_TRIES):
+            if span is not None:
+                span.attrs["tries"] = _ntry + 1
+            if self.breaker.is_open:
+                self.breaker.stats["short_circuited"] += 1
+                raise ControllerOffline(f"{self.id} is offline")
+            fetch = partial(
+                self._timed_get if key is None else self._shared_get,
+                url,
+                timeout or self.rtt.timeout(),
+                kind,
+            )
+            # между попытками очередь свободна для других запросов
+            try:
+                status, ret = await self.scheduler.run(
+                    fetch, priority=priority, deadline=deadline, key=key
+                )
+            except StaleRequest:
+                self.lg.debug("stale request dropped: %s", url)
+                raise
+            except asyncio.TimeoutError:
+                self.lg.warning("timeout while requesting %s", url)
+                self.metrics.timeout(kind, retry=_ntry < REQUEST_TRIES - 1)
+                self._request_failed()
+                if _ntry < REQUEST_TRIES - 1:
+                    await asyncio.sleep(backoff_delay(_ntry))
+                continue
+            except aiohttp.ClientConnectionError:
+                self.metrics.error(kind)
+                self._request_failed()
+                raise
+            if self.breaker.success():
+                self._controller_back()
+            return self._response(url, status, ret)
+        raise asyncio.TimeoutError(f"after {REQUEST_TRIES} tries")
+
+    def _response(self, url, status, ret):
+        if status != 200:
+            self.lg.warning("%s returned %s (%s)", url, status, ret)
+            return None
+        self.lg.debug("response %s", ret)
+        return ret
+
+    def _request_failed(self):
+        if self.breaker.failure():
+            self._warn_offline()
+            # запросы больше не выполняются, и порты не меняются: объекты нужно сразу сделать недоступными,
+            # а после восстановления связи обновить все
+            self._force_sync = True
+            self._write_states(self.entities)
+            if self._probe_task is None or self._probe_task.done():
+                self._probe_task = asyncio.create_task(self._probe())
+
+    def _controller_back(self):
+        self._notify_online()
+        # пока контроллер был недоступен, состояние могло измениться
+        self._force_sync = True
+        self.request_refresh()
+
+    async def _probe(self):
+        """
+        Проверка связи с недоступным контроллером одним легким запросом (главная страница), пока он не ответит
+        """
+        url = f"http://{self.host}/{self.sec}"
+        attempt = 0
+        while self.breaker.is_open:
+            await asyncio.sleep(
+                min(PROBE_MIN_INTERVAL * 2 ** attempt, PROBE_MAX_INTERVAL)
+                + backoff_delay(0)
+            )
+            attempt += 1
+            try:
+                await self._timed_get(url, REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                continue
+            if self.breaker.success():
+                self.lg.info("mega is online")
+                self._controller_back()
 
     async def save(self):
         await self.send_command(cmd="s")
@@ -353,37 +1047,77 @@ class MegaD:
         хранилище values
         """
         self.lg.debug(f"get port %s", port)
+        started = time.monotonic()
+        ret = await self._read_port(port, http_cmd=http_cmd, conv=conv)
+        self._commit_values({port: ret}, started)
+        self.updater.async_update_listeners()
+        return ret
+
+    async def _read_port(self, port, http_cmd="get", conv=True):
+        """
+        Запрос состояния порта без сохранения в values
+        """
         if http_cmd == "list" and conv:
             await self.request(pt=port, cmd="conv")
-            await asyncio.sleep(1)
+            await asyncio.sleep(W1_CONV_TIME)
         ret = self.parse_response(
             await self.request(pt=port, cmd=http_cmd), cmd=http_cmd
         )
         ntry = 0
-        while http_cmd == "list" and ret is None and ntry < 3:
-            await asyncio.sleep(1)
-            ret = self.parse_response(await self.request(pt=port, cmd=http_cmd))
+        while http_cmd == "list" and ret is None and ntry < W1_BUSY_TRIES:
+            await asyncio.sleep(W1_CONV_TIME)
+            ret = self.parse_response(
+                await self.request(pt=port, cmd=http_cmd), cmd=http_cmd
+            )
             ntry += 1
         self.lg.debug("parsed: %s", ret)
-        self.values[port] = ret
         return ret
 
     @property
     def ports(self):
-        return {e.port for e in self.entities}
+        return self._port_index.keys()
 
     async def get_all_ports(self, only_out=False, check_skip=False):
+        started = time.monotonic()
+        self._commit_values(await self._read_all_ports(check_skip=check_skip), started)
+
+    async def _read_all_ports(self, check_skip=False):
+        """
+        Опрос всех портов одной командой cmd=all
+        :return: новые значения только тех портов, которые изменились с прошлого ответа
+        """
         try:
             ret = await self.request(cmd="all")
         except asyncio.TimeoutError:
-            return
-        for port, x in enumerate(ret.split(";")):
+            return {}
+        return self._parse_all(ret, check_skip=check_skip)
+
+    def _parse_all(self, ret: str, check_skip=False):
+        """
+        Разбор ответа cmd=all. Ответ сравнивается с предыдущим, разбираются только изменившиеся порты. Порт так же
+        считается изменившимся, если его значение в values было перезаписано событием или командой, или если
+        результат прошлого разбора так и не был сохранен в values (цикл опроса завершился ошибкой)
+        """
+        now = time.monotonic()
+        values = {}
+        raw = ret.split(";")
+        prev = self._all_raw
+        if len(prev) < len(raw):
+            prev.extend([None] * (len(raw) - len(prev)))
+        ports = self.ports if check_skip else None
+        for port, x in enumerate(raw):
             if port in self.ds2413_ports:
                 continue
-            if check_skip and not port in self.ports:
+            if ports is not None and port not in ports:
                 continue
-            ret = self.parse_response(x)
-            self.values[port] = ret
+            cached = prev[port]
+            if cached is not None and cached[0] == x:
+                state = self.values.get(port)
+                if state is not None and state.source == SOURCE_POLL and state.ts >= cached[1]:
+                    continue
+            prev[port] = (x, now)
+            values[port] = self.parse_response(x)
+        return values
 
     async def reboot(self, save=True):
         await self.save()
@@ -414,7 +1148,7 @@ class MegaD:
             value = json.loads(msg.payload)
             if isinstance(value, dict):
                 make_ints(value)
-            self.values[port] = value
+            self.values.set(port, value, SOURCE_PUSH)
             for cb in self._callbacks[port]:
                 cb(value)
             if isinstance(value, dict):
@@ -440,30 +1174,52 @@ class MegaD:
 
     async def authenticate(self) -> bool:
         """Test if we can authenticate with the host."""
-        async with aiohttp.request("get", url=f"http://{self.host}/{self.sec}") as req:
-            if "Unauthorized" in await req.text(encoding="iso-8859-5"):
-                return False
-            else:
-                if req.status != 200:
-                    raise CannotConnect
-                return True
+        status, data = await self._get(f"http://{self.host}/{self.sec}")
+        if "Unauthorized" in data:
+            return False
+        else:
+            if status != 200:
+                raise CannotConnect
+            return True
 
     async def get_port_page(self, port):
         url = f"http://{self.host}/{self.sec}/?pt={port}"
         self.lg.debug(f"get page for port {port} {url}")
-        async with aiohttp.request("get", url) as req:
-            return await req.text(encoding="iso-8859-5")
+        _, data = await self._get(url)
+        return data
+
+    async def _parse_config(self, page: str):
+        """
+        Разбор страницы настроек порта вне event loop
+        """
+        return await self.hass.async_add_executor_job(parse_config, page)
 
     async def scan_port(self, port):
         data = await self.request(pt=port)
-        return parse_config(data)
+        return await self._parse_config(data)
+
+    async def _fetch_ports(self, nports=37):
+        """
+        Загрузка страниц портов. Страницы запрашиваются параллельно (кол-во одновременных запросов ограничено
+        self.concurrency), результаты отдаются по порядку портов, чтобы конфиг и порядок создания объектов не
+        зависели от того, какой ответ пришел раньше
+        """
+        tasks = [asyncio.create_task(self.request(pt=x)) for x in range(0, nports + 1)]
+        try:
+            pages = await asyncio.gather(*tasks)
+            for x, page in enumerate(pages):
+                if page is not None:
+                    yield x, page
+        finally:
+            for x in tasks:
+                x.cancel()
+        self.nports = nports + 1
 
     async def scan_ports(self, nports=37):
-        for x in range(0, nports + 1):
-            ret = await self.scan_port(x)
+        async for x, page in self._fetch_ports(nports):
+            ret = await self._parse_config(page)
             if ret:
                 yield x, ret
-        self.nports = nports + 1
 
     async def _update_extender(self, port):
         """
@@ -480,168 +1236,261 @@ class MegaD:
             ret[f"{port}e{i}"] = x
         return ret
 
-    async def _update_i2c(self, params):
+    async def _update_i2c(self, params, wait=True):
         """
         Обновление портов i2c
         :param params: параметры url
+        :param wait: ждать ли окончания измерения (delay) после запроса
         :return:
         """
         pt = params.get("pt")
         if pt in self.skip_ports:
             return
-        if pt is not None:
-            pass
         _params = tuple(params.items())
-        delay = None
-        if "delay" in params:
-            delay = params.pop("delay")
+        delay = params.get("delay")
         try:
-            ret = {_params: await self.request(**params)}
+            ret = {
+                _params: await self.request(
+                    **{k: v for k, v in params.items() if k != "delay"}
+                )
+            }
         except asyncio.TimeoutError:
             return
         self.lg.debug("i2c response: %s", ret)
-        if delay:
+        if delay and wait:
             self.lg.debug("delay %s", delay)
             await asyncio.sleep(delay)
         return ret
 
-    async def get_config(self, nports=37):
+    async def get_config(self, nports=37, use_cache=True):
+        """
+        Сканирование контроллера
+
+        Результат сканирования каждого порта сохраняется в кеш вместе с хешем страницы порта. Если прошивка
+        и страница порта не изменились, используется результат из кеша: страница не разбирается, а ds2413, 1-wire
+        и i2c повторно не сканируются. Для расширителей сверяются хеши страниц их выходов. Новые устройства на шинах
+        на странице порта не отражаются, их находит только явное пересканирование (use_cache=False)
+        :param nports: кол-во портов
+        :param use_cache: если False, все порты сканируются заново (кеш при этом обновляется)
+        """
+        started = time.monotonic()
+        if not self.fw:
+            self.fw = await self.get_fw()
         ret = defaultdict(lambda: defaultdict(list))
         ret["mqtt_id"] = await self.get_mqtt_id()
-        ret["extenders"] = extenders = []
-        ret["ext_in"] = ext_int = {}
-        ret["ext_acts"] = ext_acts = {}
-        ret["i2c_sensors"] = i2c_sensors = []
-        ret["smooth"] = smooth = []
-        async for port, cfg in self.scan_ports(nports):
-            _cust = self.customize.get(port)
-            if not isinstance(_cust, dict):
-                _cust = {}
-            if cfg.pty == "0":
-                ret["binary_sensor"][port].append({})
-            elif cfg.pty == "1" and (cfg.m in ["0", "1", "3"] or cfg.m is None):
-                if cfg.misc is not None:
-                    smooth.append(port)
-                ret["light"][port].append(
-                    {"dimmer": cfg.m == "1", "smooth": safe_int(cfg.misc)}
+        ret["extenders"] = []
+        ret["ext_in"] = {}
+        ret["ext_acts"] = {}
+        ret["acts"] = {}
+        ret["i2c_sensors"] = []
+        ret["smooth"] = []
+        cache = get_discovery_cache(self.hass)
+        cached = (
+            await cache.get(self.id, self.fw, self.new_naming, nports) if use_cache else {}
+        )
+        new_cache = {}
+        parsed = 0
+        async for port, page in self._fetch_ports(nports):
+            h = page_hash(page)
+            entry = cached.get(str(port))
+            if entry is not None and entry["hash"] == h and await self._ext_unchanged(port, entry):
+                fragment = entry["fragment"]
+                ext = entry["ext"]
+            else:
+                parsed += 1
+                fragment, ext = await self._discover_port(
+                    port, await self._parse_config(page), nports
                 )
-            elif cfg == DS2413:
-                # ds2413
-                _data = await self.get_port(
-                    port=port, force_http=True, http_cmd="list", conv=False
+            new_cache[str(port)] = {"hash": h, "ext": ext, "fragment": fragment}
+            self._merge_fragment(ret, fragment)
+        await cache.save(self.id, self.fw, self.new_naming, nports, new_cache)
+        self.lg.info(
+            "discovery finished in %.1fs: %s ports (%s parsed), %s extenders, %s i2c requests",
+            time.monotonic() - started,
+            nports + 1,
+            parsed,
+            len(ret["extenders"]),
+            len(ret["i2c_sensors"]),
+        )
+        return ret
+
+    @staticmethod
+    def _merge_fragment(ret, fragment: dict):
+        for section, pt, x in fragment["entities"]:
+            ret[section][pt].append(x)
+        ret["extenders"].extend(fragment["extenders"])
+        ret["ext_in"].update(dict(fragment["ext_in"]))
+        ret["ext_acts"].update(dict(fragment["ext_acts"]))
+        ret["acts"].update(dict(fragment["acts"]))
+        ret["i2c_sensors"].extend(fragment["i2c_sensors"])
+        ret["smooth"].extend(fragment["smooth"])
+
+    async def _get_ext_pages(self, port, count: int) -> typing.List[str]:
+        return await asyncio.gather(
+            *[self.request(pt=port, ext=n) for n in range(count)]
+        )
+
+    async def _ext_unchanged(self, port, entry: dict) -> bool:
+        """
+        Для расширителя из кеша: не изменились ли страницы его выходов
+        """
+        if entry["ext"] is None:
+            return True
+        count, h = entry["ext"]
+        return self._ext_hash(await self._get_ext_pages(port, count)) == h
+
+    @staticmethod
+    def _ext_hash(pages: typing.List[str]) -> str:
+        return page_hash("".join(x or "" for x in pages))
+
+    async def _discover_port(self, port, cfg, nports) -> typing.Tuple[dict, typing.Optional[list]]:
+        """
+        Сканирование одного порта
+        :return: фрагмент конфига, пригодный для сохранения в json; для расширителя mcp230 - кол-во и хеш страниц
+            его выходов
+        """
+        fragment = {
+            "entities": [],
+            "extenders": [],
+            "ext_in": [],
+            "ext_acts": [],
+            "acts": [],
+            "i2c_sensors": [],
+            "smooth": [],
+        }
+
+        ext = None
+
+        def add(section, pt, data):
+            fragment["entities"].append([section, pt, data])
+
+        if cfg.pty == "0":
+            add("binary_sensor", port, {})
+            if cfg.ecmd:
+                fragment["acts"].append([port, cfg.ecmd])
+        elif cfg.pty == "1" and (cfg.m in ["0", "1", "3"] or cfg.m is None):
+            if cfg.misc is not None:
+                fragment["smooth"].append(port)
+            add("light", port, {"dimmer": cfg.m == "1", "smooth": safe_int(cfg.misc)})
+        elif cfg == DS2413:
+            # ds2413
+            _data = await self.get_port(
+                port=port, force_http=True, http_cmd="list", conv=False
+            )
+            data = _data.get("value", {})
+            if not isinstance(data, dict):
+                self.lg.warning(
+                    f"can not add ds2413 on port {port}, it has wrong data: {_data}"
                 )
-                data = _data.get("value", {})
-                if not isinstance(data, dict):
-                    self.lg.warning(
-                        f"can not add ds2413 on port {port}, it has wrong data: {_data}"
-                    )
-                    continue
-                for addr, state in data.items():
-                    ret["light"][port].extend(
-                        [
-                            {
-                                "index": 0,
-                                "addr": addr,
-                                "id_suffix": f"{addr}_a",
-                                "http_cmd": "ds2413",
-                            },
-                            {
-                                "index": 1,
-                                "addr": addr,
-                                "id_suffix": f"{addr}_b",
-                                "http_cmd": "ds2413",
-                            },
-                        ]
-                    )
-            elif cfg == MCP230:
-                extenders.append(port)
-                if cfg.inta:
-                    ext_int[int_ignore(cfg.inta)] = port
-                values = await self.request(pt=port, cmd="get")
-                values = values.split(";")
-                for n in range(len(values)):
-                    ext_page = await self.request(pt=port, ext=n)
-                    ext_cfg = parse_config(ext_page)
-                    pt = f"{port}e{n}" if not self.new_naming else f"{port:02d}e{n:02d}"
-                    if ext_cfg.ety == "1":
-                        ret["light"][pt].append({})
-                    elif ext_cfg.ety == "0":
-                        if ext_cfg.eact:
-                            ext_acts[pt] = ext_cfg.eact
-                        ret["binary_sensor"][pt].append({})
-            elif cfg == PCA9685:
-                extenders.append(port)
-                values = await self.request(pt=port, cmd="get")
-                values = values.split(";")
-                for n in range(len(values)):
-                    pt = f"{port}e{n}"
-                    name = pt if not self.new_naming else f"{port:02}e{n:02}"
-                    ret["light"][pt].append(
+                return fragment, ext
+            for addr, state in data.items():
+                for index, suffix in enumerate(["a", "b"]):
+                    add(
+                        "light",
+                        port,
                         {
-                            "dimmer": True,
-                            "dimmer_scale": 16,
-                            "name": f"{self.id}_{name}",
-                        }
+                            "index": index,
+                            "addr": addr,
+                            "id_suffix": f"{addr}_{suffix}",
+                            "http_cmd": "ds2413",
+                        },
+                    )
+        elif cfg == MCP230:
+            fragment["extenders"].append(port)
+            if cfg.inta:
+                fragment["ext_in"].append([int_ignore(cfg.inta), port])
+            values = await self.request(pt=port, cmd="get")
+            values = values.split(";")
+            ext_pages = await self._get_ext_pages(port, len(values))
+            ext = [len(ext_pages), self._ext_hash(ext_pages)]
+            ext_cfgs = await asyncio.gather(
+                *[self._parse_config(x) for x in ext_pages]
+            )
+            for n, ext_cfg in enumerate(ext_cfgs):
+                pt = f"{port}e{n}" if not self.new_naming else f"{port:02d}e{n:02d}"
+                if ext_cfg.ety == "1":
+                    add("light", pt, {})
+                elif ext_cfg.ety == "0":
+                    if ext_cfg.eact:
+                        fragment["ext_acts"].append([pt, ext_cfg.eact])
+                    add("binary_sensor", pt, {})
+        elif cfg == PCA9685:
+            fragment["extenders"].append(port)
+            values = await self.request(pt=port, cmd="get")
+            values = values.split(";")
+            for n in range(len(values)):
+                pt = f"{port}e{n}"
+                name = pt if not self.new_naming else f"{port:02}e{n:02}"
+                add(
+                    "light",
+                    pt,
+                    {
+                        "dimmer": True,
+                        "dimmer_scale": 16,
+                        "name": f"{self.id}_{name}",
+                    },
+                )
+        if cfg.pty == "4":  # and (cfg.gr == '0' or _cust.get(CONF_FORCE_I2C_SCAN))
+            # i2c в режиме ANY
+            self.lg.debug(f"find scan link: %s", cfg.i2c_scan)
+            if cfg.i2c_scan:
+                page = await self.request(pt=port, cmd="scan", timeout=REQUEST_TIMEOUT)
+                req, parsed = parse_scan_page(page)
+                self.lg.debug(f"scan results: %s", (req, parsed))
+                for x in parsed:
+                    add("i2c", port, x)
+                fragment["i2c_sensors"].extend(req)
+        elif cfg.pty == "4" and cfg.m == "2":
+            # scl исключаем из сканирования
+            pass
+        elif cfg.pty is None and nports < 30:
+            # вроде как это ADC на 328 меге
+            add("sensor", port, dict())
+        elif cfg.pty in ("3", "2", "4"):
+            http_cmd = "get"
+            if cfg.d == "5" and cfg.pty == "3":
+                # 1-wire bus
+                values = await self.get_port(port, force_http=True, http_cmd="list")
+                http_cmd = "list"
+            else:
+                values = await self.get_port(port, force_http=True)
+                if values is None or (
+                    isinstance(values, dict)
+                    and str(values.get("value")) in ("", "None")
+                ):
+                    values = await self.get_port(
+                        port, force_http=True, http_cmd="list"
                     )
-            if cfg.pty == "4":  # and (cfg.gr == '0' or _cust.get(CONF_FORCE_I2C_SCAN))
-                # i2c в режиме ANY
-                scan = cfg.src.find("a", text="I2C Scan")
-                self.lg.debug(f"find scan link: %s", scan)
-                if scan is not None:
-                    page = await self.request(pt=port, cmd="scan")
-                    req, parsed = parse_scan_page(page)
-                    self.lg.debug(f"scan results: %s", (req, parsed))
-                    ret["i2c"][port].extend(parsed)
-                    i2c_sensors.extend(req)
-            elif cfg.pty == "4" and cfg.m == "2":
-                # scl исключаем из сканирования
-                continue
-            elif cfg.pty is None and nports < 30:
-                # вроде как это ADC на 328 меге
-                ret["sensor"][port].append(dict())
-            elif cfg.pty in ("3", "2", "4"):
-                http_cmd = "get"
-                if cfg.d == "5" and cfg.pty == "3":
-                    # 1-wire bus
-                    values = await self.get_port(port, force_http=True, http_cmd="list")
                     http_cmd = "list"
+            self.lg.debug(f"values: %s", values)
+            if values is None:
+                self.lg.warning(
+                    f"port {port} is of type sensor but response is None, skipping it"
+                )
+                return fragment, ext
+            if isinstance(values, dict) and "value" in values:
+                values = values["value"]
+            if isinstance(values, str) and TEMP_PATT.search(values):
+                values = {TEMP: values}
+            elif not isinstance(values, dict):
+                if cfg.pty == "4" and cfg.d in I2C_DEVICE_TYPES:
+                    values = {I2C_DEVICE_TYPES.get(cfg.m): values}
                 else:
-                    values = await self.get_port(port, force_http=True)
-                    if values is None or (
-                        isinstance(values, dict)
-                        and str(values.get("value")) in ("", "None")
-                    ):
-                        values = await self.get_port(
-                            port, force_http=True, http_cmd="list"
-                        )
-                        http_cmd = "list"
-                self.lg.debug(f"values: %s", values)
-                if values is None:
-                    self.lg.warning(
-                        f"port {port} is of type sensor but response is None, skipping it"
-                    )
-                    continue
-                if isinstance(values, dict) and "value" in values:
-                    values = values["value"]
-                if isinstance(values, str) and TEMP_PATT.search(values):
-                    values = {TEMP: values}
-                elif not isinstance(values, dict):
-                    if cfg.pty == "4" and cfg.d in I2C_DEVICE_TYPES:
-                        values = {I2C_DEVICE_TYPES.get(cfg.m): values}
-                    else:
-                        values = {None: values}
-                for key in values:
-                    self.lg.debug(f"add sensor {key}")
-                    ret["sensor"][port].append(
-                        dict(
-                            key=key,
-                            unit_of_measurement=UNITS.get(key, UNITS[TEMP]),
-                            device_class=CLASSES.get(key, CLASSES[TEMP]),
-                            id_suffix=key,
-                            http_cmd=http_cmd,
-                        )
-                    )
-        return ret
+                    values = {None: values}
+            for key in values:
+                self.lg.debug(f"add sensor {key}")
+                add(
+                    "sensor",
+                    port,
+                    dict(
+                        key=key,
+                        unit_of_measurement=UNITS.get(key, UNITS[TEMP]),
+                        device_class=CLASSES.get(key, CLASSES[TEMP]),
+                        id_suffix=key,
+                        http_cmd=http_cmd,
+                    ),
+                )
+        return fragment, ext
 
     async def restore_states(self):
         for x in self.entities:
@@ -654,8 +1503,8 @@ class MegaD:
     async def update_time(self):
         await self.request(cf=7, stime=datetime.now().strftime("%H:%M:%S"))
 
-    async def reload(self, reload_entry=True):
-        new = await self.get_config(nports=self.nports)
+    async def reload(self, reload_entry=True, use_cache=True):
+        new = await self.get_config(nports=self.nports, use_cache=use_cache)
         cfg = dict(self.config.data)
         for x in REMOVE_CONFIG:
             cfg.pop(x, None)
@@ -666,24 +1515,36 @@ class MegaD:
             await self.hass.config_entries.async_reload(self.config.entry_id)
         return cfg
 
-    def _wrap_port_smooth(self, from_, to_, time):
-        self.lg.debug("dim from %s to %s for %s seconds", from_, to_, time)
-        if time <= 0:
-            return
-        beg = datetime.now()
-        diff = to_ - from_
-        while True:
-            _pct = (datetime.now() - beg).total_seconds() / time
-            if _pct > 1:
-                return
-            val = from_ + round(diff * _pct)
-            yield val
+    async def _send_commands(self, cmd: str):
+        return await self.request(cmd=cmd, priority=PRIORITY_COMMAND)
+
+    def queue_command(self, cmd: str) -> asyncio.Future:
+        """
+        Команда вида port:value, команды от разных объектов, отправленные почти одновременно (например, сценой),
+        уходят на контроллер одним запросом cmd=pt:v;pt:v;...
+        """
+        return self.commands.submit(cmd)
+
+    def can_smooth_port(self, port) -> bool:
+        """
+        Порт поддерживает аппаратный smooth (pwm с плавным изменением силами контроллера)
+        """
+        return isinstance(port, int) and port in self.smooth
+
+    def plan_smooth(self, *config: typing.Tuple[typing.Any, int, int], ws=False) -> typing.List[int]:
+        """
+        Разделение каналов перехода на аппаратные и программные
+
+        :return: индексы каналов, которые можно отдать контроллеру
+        """
+        if ws:
+            return []
+        return [i for i, (pt, _, _) in enumerate(config) if self.can_smooth_port(pt)]
 
     async def smooth_dim(
         self,
         *config: typing.Tuple[typing.Any, int, int],
         time: float,
-        jitter: int = 50,
         ws=False,
         updater=None,
         can_smooth_hardware=False,
@@ -691,63 +1552,44 @@ class MegaD:
         chip=None,
     ):
         """
-        Плавное диммирование силами сервера, сразу нескольких портов (одной командой)
+        Плавное диммирование сразу нескольких портов. Порты с аппаратным smooth получают одну команду pwm/cnt и
+        дальше диммируются контроллером, их значения для updater только рассчитываются. Остальные порты диммирует
+        общий для всех светильников контроллера цикл self.dimmer. Команды pwm/cnt отправляются вместе с первым
+        кадром программных каналов, чтобы все каналы группы начинали переход одновременно
 
         :param config: [(port, from, to), (port, from, to)]
         :param time: время на диммирование
-        :param jitter: дополнительное замедление между командами в милисекундах
         :param ws: если True, используется режим ws21xx
         :param updater: функция, в которую передается текущее состояние
-        :param can_smooth_hardware: если True, используется аппаратная реализация smooth
+        :param can_smooth_hardware: если True, для портов с аппаратным smooth используется аппаратная реализация
         :param max_values: максимальные значения (необходимы для расчета тайминга аппаратного smooth)
         :param chip: кол-во чипов для ws-лент
         :return:
         """
-        if can_smooth_hardware:
-            for i, (pt, from_, to_) in enumerate(config):
-                pct = abs(from_ - to_) / max_values[i]
-                tm = max([round(time / pct), 1])
-                await self.request(pt=pt, pwm=to_, cnt=tm)
-
-        last_step = tuple([to_ for (_, _, to_) in config])
-        gen = [self._wrap_port_smooth(f, t, time) for (_, f, t) in config]
-        c = None
-        stop = False
-        while True:
-            if stop:
-                return
-            await asyncio.sleep(jitter / 1000)
-            try:
-                _next_val = tuple([next(x) for x in gen])
-            except StopIteration:
-                _next_val = last_step
-                stop = True
-            if _next_val == c:
-                continue
-            if updater is not None:
-                updater(_next_val)
-            if can_smooth_hardware:
-                if _next_val == last_step:
-                    return
+        hardware = []
+        if can_smooth_hardware and max_values:
+            hardware = self.plan_smooth(*config, ws=ws)
+        cmds = []
+        for i in hardware:
+            pt, from_, to_ = config[i]
+            if from_ == to_:
                 continue
-            if not ws:
-                cmd = dict(
-                    cmd=";".join(
-                        [f"{pt}:{_next_val[i]}" for i, (pt, _, _) in enumerate(config)]
-                    )
-                )
-                await self.request(**cmd)
-            else:
-                # для адресных лент
-                cmd = dict(
-                    pt=config[0][0],
-                    chip=chip,
-                    ws="".join(
-                        [hex(x).split("x")[1].rjust(2, "0").upper() for x in _next_val]
-                    ),
-                )
-                await self.request(**cmd)
+            pct = abs(from_ - to_) / max_values[i]
+            tm = max([round(time / pct), 1])
+            # в синтаксисе cmd=pt:v;... нет времени перехода, поэтому каждый порт получает свой запрос
+            cmds.append(self.request(pt=pt, pwm=to_, cnt=tm, priority=PRIORITY_COMMAND))
 
-            if _next_val == last_step:
-                return
-            c = _next_val
+        tr = self.dimmer.start(
+            *config,
+            time=time,
+            updater=updater,
+            ws=ws,
+            chip=chip,
+            hardware=hardware,
+        )
+        try:
+            if cmds:
+                await asyncio.gather(*cmds)
+            await tr.future
+        finally:
+            self.dimmer.discard(tr)
@@ -9,7 +9,6 @@ from functools import partial
 
 import voluptuous as vol
 import colorsys
-import time
 
 from homeassistant.components.light import (
     PLATFORM_SCHEMA as LIGHT_SCHEMA,
@@ -48,7 +47,7 @@ from .const import (
     CONF_CHIP,
     RGB,
 )
-from .tools import int_ignore, map_reorder_rgb
+from .tools import int_ignore, map_reorder_rgb, IntentQueue
 
 lg = logging.getLogger(__name__)
 SCAN_INTERVAL = timedelta(seconds=5)
@@ -141,7 +140,9 @@ class MegaRGBW(LightEntity, BaseMegaEntity):
         self._restore = None
         self.smooth: timedelta = self.customize[CONF_SMOOTH]
         self._color_order = self.customize.get(CONF_ORDER, "rgb")
-        self._last_called: float = 0
+        self._intents = IntentQueue()
+        # параметры еще не выполненных вызовов turn_on, частые вызовы схлопываются в один
+        self._intent_kwargs = {}
         self._max_values = None
 
     @property
@@ -226,9 +227,15 @@ class MegaRGBW(LightEntity, BaseMegaEntity):
         return rgb
 
     async def async_turn_on(self, **kwargs):
-        if (time.time() - self._last_called) < 0.1:
-            return
-        self._last_called = time.time()
+        self._intent_kwargs.update(kwargs)
+        await self._intents.submit(self._turn_on)
+
+    async def async_turn_off(self, **kwargs):
+        self._intent_kwargs = {}
+        await self._intents.submit(partial(self._turn_off, **kwargs))
+
+    async def _turn_on(self):
+        kwargs, self._intent_kwargs = self._intent_kwargs, {}
         self.lg.debug(f"turn on %s with kwargs %s", self.entity_id, kwargs)
         if self._restore is not None:
             self._restore.update(kwargs)
@@ -240,10 +247,7 @@ class MegaRGBW(LightEntity, BaseMegaEntity):
             self._task.cancel()
         self._task = asyncio.create_task(self.set_color(_before, **kwargs))
 
-    async def async_turn_off(self, **kwargs):
-        if (time.time() - self._last_called) < 0.1:
-            return
-        self._last_called = time.time()
+    async def _turn_off(self, **kwargs):
         self._restore = {
             "hs_color": self.hs_color,
             "brightness": self.brightness,
@@ -277,7 +281,6 @@ class MegaRGBW(LightEntity, BaseMegaEntity):
                 *config,
                 time=transition,
                 ws=self.is_ws,
-                jitter=50,
                 updater=partial(self._update_from_rgb, update_state=update_state),
                 can_smooth_hardware=self.can_smooth_hardware,
                 max_values=self.max_values,
@@ -290,6 +293,7 @@ class MegaRGBW(LightEntity, BaseMegaEntity):
 
     async def async_will_remove_from_hass(self) -> None:
         await super().async_will_remove_from_hass()
+        self._intents.cancel()
         if self._task is not None:
             self._task.cancel()
 
@@ -333,13 +337,10 @@ class MegaRGBW(LightEntity, BaseMegaEntity):
             return
         rgbw = []
         for x in self.port:
-            data = self.coordinator.data
-            if not isinstance(data, dict):
+            state = self.mega.values.get(x)
+            if state is None:
                 return
-            data = data.get(x, None)
-            if isinstance(data, dict):
-                data = data.get("value")
-            data = safe_int(data)
+            data = safe_int(state.value)
             if data is None:
                 return
             rgbw.append(data)
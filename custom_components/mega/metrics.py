@@ -0,0 +1,161 @@
+"""Метрики запросов к контроллеру"""
+import typing
+from bisect import bisect_left
+
+# границы корзин гистограммы времени, сек
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+READ_KINDS = ("all", "get", "list", "conv", "scan")
+KINDS = READ_KINDS + ("i2c", "cmd", "page")
+
+
+def request_kind(params: dict) -> str:
+    """
+    Тип запроса для метрик: all, get, list, conv, scan, cmd (команды портов), i2c, page (страницы и прочее)
+    """
+    cmd = params.get("cmd")
+    if cmd in READ_KINDS:
+        return cmd
+    if "i2c_dev" in params or "scl" in params or "i2c" in params:
+        return "i2c"
+    if cmd is not None:
+        return "cmd"
+    return "page"
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами, наблюдение не создает новых объектов
+    """
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: typing.Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        """
+        Оценка квантиля по верхней границе корзины
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        acc = 0
+        for i, cnt in enumerate(self.counts):
+            acc += cnt
+            if acc >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    @property
+    def mean(self) -> typing.Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            "buckets": dict(zip([str(x) for x in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+class KindMetrics:
+    __slots__ = ("count", "timeouts", "retries", "errors", "bytes", "latency")
+
+    def __init__(self):
+        self.count = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "latency": self.latency.as_dict(),
+        }
+
+
+class HubMetrics:
+    """
+    Счетчики и гистограммы запросов одного контроллера по типам запросов, время ожидания в очереди
+    """
+
+    def __init__(self):
+        self.kinds: typing.Dict[str, KindMetrics] = {}
+        self.queue_wait = Histogram()
+
+    def _kind(self, kind: str) -> KindMetrics:
+        ret = self.kinds.get(kind)
+        if ret is None:
+            ret = self.kinds[kind] = KindMetrics()
+        return ret
+
+    def response(self, kind: str, latency: float, size: int):
+        m = self._kind(kind)
+        m.count += 1
+        m.bytes += size
+        m.latency.observe(latency)
+
+    def timeout(self, kind: str, retry: bool):
+        m = self._kind(kind)
+        m.timeouts += 1
+        if retry:
+            m.retries += 1
+
+    def error(self, kind: str):
+        self._kind(kind).errors += 1
+
+    def wait(self, seconds: float):
+        self.queue_wait.observe(seconds)
+
+    @property
+    def requests(self) -> int:
+        return sum(x.count for x in self.kinds.values())
+
+    @property
+    def timeouts(self) -> int:
+        return sum(x.timeouts for x in self.kinds.values())
+
+    @property
+    def retries(self) -> int:
+        return sum(x.retries for x in self.kinds.values())
+
+    @property
+    def bytes(self) -> int:
+        return sum(x.bytes for x in self.kinds.values())
+
+    def latency(self, q: float) -> typing.Optional[float]:
+        """
+        Квантиль времени ответа по всем типам запросов
+        """
+        total = Histogram()
+        for m in self.kinds.values():
+            for i, cnt in enumerate(m.latency.counts):
+                total.counts[i] += cnt
+            total.count += m.latency.count
+            total.max = max(total.max, m.latency.max)
+        return total.quantile(q)
+
+    def as_dict(self) -> dict:
+        return {
+            "kinds": {k: v.as_dict() for k, v in self.kinds.items()},
+            "queue_wait": self.queue_wait.as_dict(),
+        }
@@ -1,7 +1,9 @@
 """Platform for light integration."""
 import logging
+import typing
 import voluptuous as vol
 import struct
+from dataclasses import dataclass
 
 from homeassistant.components.sensor import (
     PLATFORM_SCHEMA as SENSOR_SCHEMA, SensorEntity, SensorDeviceClass
@@ -16,11 +18,15 @@ from homeassistant.const import (
     CONF_DEVICE_CLASS,
 )
 from homeassistant.core import HomeAssistant
+from homeassistant.exceptions import TemplateError
+from homeassistant.helpers.entity import DeviceInfo, EntityCategory
 from homeassistant.helpers.template import Template
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
 from .entities import MegaPushEntity
 from .const import CONF_KEY, TEMP, HUM, W1, W1BUS, CONF_CONV_TEMPLATE, CONF_HEX_TO_FLOAT, DOMAIN, CONF_CUSTOM, \
     CONF_SKIP, CONF_FILTER_VALUES, CONF_FILTER_SCALE, CONF_FILTER_LOW, CONF_FILTER_HIGH, CONF_FILL_NA
 from .hub import MegaD
+from .metrics import KINDS
 import re
 
 from .tools import int_ignore
@@ -102,30 +108,100 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry, asyn
                 if '<' in sensor.name:
                     continue
                 devices.append(sensor)
+    devices.extend(MegaMetricSensor(hub, *x) for x in METRIC_SENSORS)
 
     async_add_devices(devices)
 
 
+@dataclass(frozen=True)
+class SensorCustomize:
+    """
+    Параметры обработки значений датчика, собранные из кастомизации объекта и контроллера
+    """
+    filter_values: tuple = ()
+    filter_scale: float = None
+    filter_low: float = None
+    filter_high: float = None
+    fill_na: str = 'last'
+    hex_to_float: bool = False
+    template: typing.Optional[Template] = None
+
+
 class FilterBadValues(MegaPushEntity, SensorEntity):
 
     def __init__(self, *args, **kwargs):
         self._prev_value = None
+        self._sensor_cfg: typing.Optional[SensorCustomize] = None
         super().__init__(*args, **kwargs)
 
-    def filter_value(self, value):
+    @property
+    def sensor_cfg(self) -> SensorCustomize:
+        """
+        Кастомизация датчика в готовом виде: значения фильтров и скомпилированный шаблон. Пока объект не добавлен в
+        HA, не кешируется
+        """
+        if self._sensor_cfg is not None:
+            return self._sensor_cfg
+        if self.hass is None or self.entity_id is None:
+            return self._build_sensor_cfg()
+        self._sensor_cfg = self._build_sensor_cfg()
+        return self._sensor_cfg
+
+    def _build_sensor_cfg(self) -> SensorCustomize:
+        c = self.customize
+        mc = self.mega.customize
+        tmpl: Template = c.get(CONF_CONV_TEMPLATE, c.get(CONF_VALUE_TEMPLATE))
+        if tmpl is not None and self.hass is not None:
+            tmpl.hass = self.hass
+            try:
+                tmpl.ensure_valid()
+            except TemplateError:
+                self.lg.exception(f'{self.entity_id}: bad template {tmpl.template}')
+                tmpl = None
+        return SensorCustomize(
+            filter_values=tuple(c.get(CONF_FILTER_VALUES, mc.get(CONF_FILTER_VALUES, []))),
+            filter_scale=c.get(CONF_FILTER_SCALE, mc.get(CONF_FILTER_SCALE, None)),
+            filter_low=c.get(CONF_FILTER_LOW, mc.get(CONF_FILTER_LOW, None)),
+            filter_high=c.get(CONF_FILTER_HIGH, mc.get(CONF_FILTER_HIGH, None)),
+            fill_na=c.get(CONF_FILL_NA, 'last'),
+            hex_to_float=bool(c.get(CONF_HEX_TO_FLOAT)),
+            template=tmpl if self.hass is not None else None,
+        )
+
+    def invalidate_customize(self):
+        super().invalidate_customize()
+        self._sensor_cfg = None
+
+    def convert_value(self, ret, cfg: SensorCustomize):
+        if cfg.hex_to_float:
+            try:
+                ret = struct.unpack('!f', bytes.fromhex(ret))[0]
+            except:
+                self.lg.warning(f'could not convert {ret} form hex to float')
+        try:
+            ret = float(ret)
+            if cfg.template is not None:
+                ret = cfg.template.async_render({'value': ret})
+        except:
+            pass
+        return ret
+
+    def filter_value(self, value, cfg: SensorCustomize = None):
+        if cfg is None:
+            cfg = self.sensor_cfg
         try:
             if value \
-                    in self.filter_values \
-                    or (self.filter_low is not None and value < self.filter_low) \
-                    or (self.filter_high is not None and value > self.filter_high) \
+                    in cfg.filter_values \
+                    or (cfg.filter_low is not None and value < cfg.filter_low) \
+                    or (cfg.filter_high is not None and value > cfg.filter_high) \
                     or (
                     self._prev_value is not None
-                    and self.filter_scale is not None
+                    and cfg.filter_scale is not None
                     and (
-                            abs(value - self._prev_value) / self._prev_value > self.filter_scale
+                            abs(value - self._prev_value) / self._prev_value > cfg.filter_scale
                     )
             ):
-                if self.fill_na == 'last':
+                if cfg.fill_na == 'last':
                     value = self._prev_value
                 else:
                     value = None
@@ -137,23 +213,23 @@ class FilterBadValues(MegaPushEntity, SensorEntity):
 
     @property
     def filter_values(self):
-        return self.customize.get(CONF_FILTER_VALUES, self.mega.customize.get(CONF_FILTER_VALUES, []))
+        return self.sensor_cfg.filter_values
 
     @property
     def filter_scale(self):
-        return self.customize.get(CONF_FILTER_SCALE, self.mega.customize.get(CONF_FILTER_SCALE, None))
+        return self.sensor_cfg.filter_scale
 
     @property
     def filter_low(self):
-        return self.customize.get(CONF_FILTER_LOW, self.mega.customize.get(CONF_FILTER_LOW, None))
+        return self.sensor_cfg.filter_low
 
     @property
     def filter_high(self):
-        return self.customize.get(CONF_FILTER_HIGH, self.mega.customize.get(CONF_FILTER_HIGH, None))
+        return self.sensor_cfg.filter_high
 
     @property
     def fill_na(self):
-        return self.customize.get(CONF_FILL_NA, 'last')
+        return self.sensor_cfg.fill_na
 
 
 class MegaI2C(FilterBadValues):
@@ -171,15 +247,17 @@ class MegaI2C(FilterBadValues):
         self._unit_of_measurement = unit_of_measurement
         super().__init__(*args, **kwargs)
 
-    @property
-    def customize(self):
-        ret = super().customize
+    def _resolve_customize(self) -> dict:
+        ret = super()._resolve_customize()
         _old = ret.get(self.id_suffix)
         if _old is not None:
-            ret = ret.copy()
             ret.update(_old)
         return ret
 
+    @property
+    def state_keys(self) -> tuple:
+        return self._params,
+
     @property
     def extra_state_attributes(self):
         attrs = super().extra_state_attributes or {}
@@ -199,21 +277,11 @@ class MegaI2C(FilterBadValues):
     @property
     def native_value(self):
         try:
-            ret = self.mega.values.get(self._params)
-            if self.customize.get(CONF_HEX_TO_FLOAT):
-                try:
-                    ret = struct.unpack('!f', bytes.fromhex(ret))[0]
-                except:
-                    self.lg.warning(f'could not convert {ret} form hex to float')
-            tmpl: Template = self.customize.get(CONF_CONV_TEMPLATE, self.customize.get(CONF_VALUE_TEMPLATE))
-            try:
-                ret = float(ret)
-                if tmpl is not None and self.hass is not None:
-                    tmpl.hass = self.hass
-                    ret = tmpl.async_render({'value': ret})
-            except:
-                ret = ret
-            ret = self.filter_value(ret)
+            cfg = self.sensor_cfg
+            state = self.mega.values.get(self._params)
+            ret = state.value if state is not None else None
+            ret = self.convert_value(ret, cfg)
+            ret = self.filter_value(ret, cfg)
             if ret is not None:
                 return str(ret)
         except Exception:
@@ -286,21 +354,15 @@ class Mega1WSensor(FilterBadValues):
             ret = None
             if not hasattr(self, 'key'):
                 return None
-            if self.key:
-                try:
-                    ret = self.mega.values.get(self.port, {})
-                    if isinstance(ret, dict):
-                        ret = ret.get('value', {})
-                        if isinstance(ret, dict):
-                            ret = ret.get(self.key)
-                except:
-                    self.lg.error(self.mega.values.get(self.port, {}).get('value', {}))
-                    return
-            else:
-                ret = self.mega.values.get(self.port, {}).get('value')
-            if ret is None and self.fill_na == 'fill_na' and self.prev_value is not None:
+            cfg = self.sensor_cfg
+            state = self.mega.values.get(self.port)
+            if state is not None:
+                ret = state.value
+                if self.key and isinstance(ret, dict):
+                    ret = ret.get(self.key)
+            if ret is None and cfg.fill_na == 'fill_na' and self.prev_value is not None:
                 ret = self.prev_value
-            elif ret is None and self.fill_na == 'fill_na' and self._state is not None:
+            elif ret is None and cfg.fill_na == 'fill_na' and self._state is not None:
                 ret = self._state.state
             try:
                 ret = float(ret)
@@ -308,20 +370,8 @@ class Mega1WSensor(FilterBadValues):
             except:
                 self.lg.debug(f'could not convert to float "{ret}"')
                 ret = self.prev_value
-            if self.customize.get(CONF_HEX_TO_FLOAT):
-                try:
-                    ret = struct.unpack('!f', bytes.fromhex(ret))[0]
-                except:
-                    self.lg.warning(f'could not convert {ret} form hex to float')
-            tmpl: Template = self.customize.get(CONF_CONV_TEMPLATE, self.customize.get(CONF_VALUE_TEMPLATE))
-            try:
-                ret = float(ret)
-                if tmpl is not None and self.hass is not None:
-                    tmpl.hass = self.hass
-                    ret = tmpl.async_render({'value': ret})
-            except:
-                pass
-            ret = self.filter_value(ret)
+            ret = self.convert_value(ret, cfg)
+            ret = self.filter_value(ret, cfg)
             self.prev_value = ret
             if ret is not None:
                 return str(ret)
@@ -341,6 +391,93 @@ class Mega1WSensor(FilterBadValues):
         return c or n
 
 
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def _latency_attrs(mega: MegaD) -> dict:
+    return {
+        k: {
+            'p50_ms': _ms(m.latency.quantile(0.5)),
+            'p95_ms': _ms(m.latency.quantile(0.95)),
+            'max_ms': _ms(m.latency.max),
+        }
+        for k, m in mega.metrics.kinds.items()
+    }
+
+
+# диагностические датчики хаба: (ключ, название, единицы, значение, атрибуты)
+METRIC_SENSORS = [
+    (
+        'requests', 'requests', None,
+        lambda mega: mega.metrics.requests,
+        lambda mega: {k: m.count for k, m in mega.metrics.kinds.items()},
+    ),
+    (
+        'latency', 'request latency p95', 'ms',
+        lambda mega: _ms(mega.metrics.latency(0.95)),
+        _latency_attrs,
+    ),
+    (
+        'timeouts', 'request timeouts', None,
+        lambda mega: mega.metrics.timeouts,
+        lambda mega: {'retries': mega.metrics.retries, **{k: m.timeouts for k, m in mega.metrics.kinds.items()}},
+    ),
+    (
+        'queue_wait', 'queue wait p95', 'ms',
+        lambda mega: _ms(mega.metrics.queue_wait.quantile(0.95)),
+        lambda mega: {'max_ms': _ms(mega.metrics.queue_wait.max), 'depth': mega.scheduler.depth},
+    ),
+    (
+        'bytes_received', 'bytes received', 'B',
+        lambda mega: mega.metrics.bytes,
+        None,
+    ),
+]
+
+
+class MegaMetricSensor(CoordinatorEntity, SensorEntity):
+    """
+    Диагностический датчик с метриками запросов к контроллеру, обновляется после каждого опроса. По умолчанию
+    выключен, разбивка по типам запросов в атрибутах в историю не пишется
+    """
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+    _unrecorded_attributes = frozenset({*KINDS, 'retries', 'max_ms', 'depth'})
+
+    def __init__(self, mega: MegaD, key, name, unit, value, attrs=None):
+        super().__init__(coordinator=mega.updater)
+        self.mega = mega
+        self._value = value
+        self._attrs = attrs
+        self._attr_unique_id = f'mega_{mega.id}_metrics_{key}'
+        self._attr_name = f'{mega.id} {name}'
+        self._attr_native_unit_of_measurement = unit
+        self._attr_state_class = 'measurement' if unit == 'ms' else 'total_increasing'
+
+    @property
+    def device_info(self) -> DeviceInfo:
+        return DeviceInfo(
+            identifiers={(DOMAIN, self.mega.id)},
+            name=self.mega.id,
+            manufacturer='ab-log.ru',
+            sw_version=self.mega.fw,
+        )
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    @property
+    def native_value(self):
+        return self._value(self.mega)
+
+    @property
+    def extra_state_attributes(self):
+        if self._attrs is not None:
+            return self._attrs(self.mega)
+
+
 _constructors = {
     'sensor': Mega1WSensor,
     'i2c': MegaI2C,
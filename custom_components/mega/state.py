@@ -0,0 +1,125 @@
+"""Хранилище состояний портов"""
+import time
+import typing
+from collections.abc import Mapping
+
+SOURCE_POLL = 'poll'
+SOURCE_PUSH = 'push'
+SOURCE_OPTIMISTIC = 'optimistic'
+
+
+def to_number(x) -> typing.Union[int, float, None]:
+    if isinstance(x, (int, float)) and not isinstance(x, bool):
+        return x
+    try:
+        return int(x)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def token_is_on(token) -> typing.Optional[bool]:
+    """
+    Интерпретация значения порта как вкл/выкл: ON/OFF, 1/0, числа больше нуля. None, если значение не распознано
+    """
+    if token == 'ON':
+        return True
+    elif token == 'OFF':
+        return False
+    num = to_number(token)
+    if num is None:
+        return None
+    return num > 0
+
+
+class PortState:
+    """
+    Состояние одного порта (или любого другого ключа хранилища, например параметров i2c-запроса)
+
+    raw - значение в том виде, в котором оно пришло (токен ответа контроллера, словарь датчика или события)
+    value - значение порта: строка, число, либо словарь для портов с несколькими значениями (1-wire шина, dht)
+    num - числовое значение, если его удалось получить
+    is_on - интерпретация значения как вкл/выкл, None если неприменимо
+    ts - время обновления (time.monotonic)
+    source - источник: poll, push или optimistic
+    """
+    __slots__ = ('raw', 'value', 'num', 'is_on', 'ts', 'source')
+
+    def __init__(self, raw, source: str):
+        self.raw = raw
+        self.ts = time.monotonic()
+        self.source = source
+        value = raw
+        if isinstance(raw, dict) and 'value' not in raw and 'm' in raw:
+            # событие входа без значения: m=1 - отпускание, остальное - нажатие
+            self.value = None
+            self.num = None
+            m = raw.get('m')
+            self.is_on = m != 1 if isinstance(m, int) else None
+            return
+        if isinstance(raw, dict) and 'value' in raw:
+            value = raw['value']
+        self.value = value
+        if isinstance(value, dict) or value is None:
+            self.num = None
+            self.is_on = None
+        else:
+            self.num = to_number(value)
+            self.is_on = token_is_on(value)
+
+    def __repr__(self):
+        return f'PortState({self.raw!r}, {self.source})'
+
+
+def unwrap(value):
+    """
+    Результат разбора ответа контроллера имеет вид {"value": ...}, в хранилище держим только само значение
+    """
+    if isinstance(value, dict) and len(value) == 1 and 'value' in value:
+        return value['value']
+    return value
+
+
+class StateStore(Mapping):
+    """
+    Хранилище состояний портов хаба: ключ values -> PortState
+    """
+
+    def __init__(self):
+        self._data: typing.Dict[typing.Any, PortState] = {}
+
+    def __getitem__(self, key) -> PortState:
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def set(self, key, value, source: str = SOURCE_POLL) -> PortState:
+        ret = self._data[key] = PortState(unwrap(value), source)
+        return ret
+
+    def update(self, values: dict, source: str = SOURCE_POLL, started: float = None) -> set:
+        """
+        :param started: время начала чтения values (time.monotonic()). Значения, записанные после этого не опросом
+            (оптимистичные после команд, события), новее прочитанных и не перезаписываются
+        :return: ключи, значения которых изменились
+        """
+        changed = set()
+        for key, value in values.items():
+            value = unwrap(value)
+            prev = self._data.get(key)
+            if started is not None and prev is not None and prev.source != SOURCE_POLL and prev.ts > started:
+                continue
+            if prev is not None and prev.raw == value:
+                prev.ts = time.monotonic()
+                prev.source = source
+                continue
+            changed.add(key)
+            self._data[key] = PortState(value, source)
+        return changed
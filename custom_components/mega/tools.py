@@ -1,7 +1,10 @@
 import asyncio
+import collections
 import itertools
-from heapq import heappush
-from contextlib import asynccontextmanager
+import random
+import time
+import typing
+from heapq import heappush, heappop
 
 
 _params = ['m', 'click', 'cnt', 'pt']
@@ -26,99 +29,426 @@ def int_ignore(x):
         return x
 
 
-class PriorityLock(asyncio.Lock):
+class StaleRequest(asyncio.TimeoutError):
     """
-    You can acquire lock with some kind of priority in mind, so that locks with higher priority will be released first.
-    priority can be set with lck.acquire(1)
-    or by using context manager:
-    >>> lck = PriorityLock()
-    ... async with lck(1):
-    ...     # do something
+    Request was dropped by RequestScheduler because its deadline passed while it was queued
     """
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+
+
+class _Job:
+    __slots__ = ('action', 'priority', 'deadline', 'key', 'future', 'waiters', 'queued', 'started')
+
+    def __init__(self, action, priority, deadline, key):
+        self.action = action
+        self.priority = priority
+        self.deadline = deadline
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_event_loop().create_future()
+        self.waiters = 0
+        self.queued = time.monotonic()
+        self.started = False
+
+
+class RequestScheduler:
+    """
+    Runs coroutine functions with at most `concurrency` of them at the same time. Queued jobs are started in order of
+    priority (lower first), then in order of submission. A job whose deadline (time.monotonic()) passes while it is
+    queued is dropped with StaleRequest. Jobs submitted with the same key while the first one is still queued are
+    merged: all callers get the result of one call. A job is dropped if all its callers are cancelled before it starts.
+    >>> sched = RequestScheduler(concurrency=1)
+    ... await sched.run(partial(fetch, url), priority=-1)
+    ... await sched.run(partial(fetch, url), priority=1, deadline=time.monotonic() + 10, key=url)
+    """
+    def __init__(self, concurrency=1, on_wait: typing.Callable[[float], typing.Any] = None):
+        self._concurrency = max(concurrency, 1)
+        self._on_wait = on_wait
+        self._running = 0
+        self._heap: typing.List[tuple] = []
+        self._queued: typing.Dict[typing.Hashable, _Job] = {}
         self._cnt = itertools.count()
+        self.stats = {
+            'submitted': 0,
+            'merged': 0,
+            'stale': 0,
+            'executed': 0,
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'last_wait': None,
+            'max_wait': 0.0,
+        }
 
-    def __call__(self, priority=0):
-        return self._with_priority(priority)
+    @property
+    def depth(self) -> int:
+        return self.stats['queue_depth']
 
-    @asynccontextmanager
-    async def _with_priority(self, p):
-        await self.acquire(p)
+    async def run(self, action, priority=0, deadline: float = None, key: typing.Hashable = None):
+        self.stats['submitted'] += 1
+        job = self._queued.get(key) if key is not None else None
+        if job is not None:
+            self.stats['merged'] += 1
+            if job.deadline is not None:
+                job.deadline = None if deadline is None else max(job.deadline, deadline)
+            if priority < job.priority:
+                # the old heap entry will be skipped
+                job.priority = priority
+                heappush(self._heap, (priority, next(self._cnt), job))
+        else:
+            job = _Job(action, priority, deadline, key)
+            if key is not None:
+                self._queued[key] = job
+            heappush(self._heap, (priority, next(self._cnt), job))
+            self._set_depth(+1)
+        job.waiters += 1
+        self._dispatch()
         try:
-            yield
-        finally:
-            self.release()
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            job.waiters -= 1
+            if job.waiters <= 0 and not job.started and not job.future.done():
+                self._drop(job)
+                job.future.cancel()
+            raise
 
-    @property
-    def _loop(self):
-        return asyncio.get_event_loop()
-
-    async def acquire(self, priority=0) -> bool:
-        """Acquire a lock.
-
-                This method blocks until the lock is unlocked, then sets it to
-                locked and returns True.
-                """
-        if (not self._locked and (self._waiters is None or
-                                  all(w.cancelled() for _, _, w in self._waiters))):
-            self._locked = True
-            return True
+    def _set_depth(self, diff: int):
+        self.stats['queue_depth'] += diff
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.stats['queue_depth'])
 
-        if self._waiters is None:
-            self._waiters = []
+    def _drop(self, job: _Job):
+        if self._queued.get(job.key) is job:
+            del self._queued[job.key]
+        self._set_depth(-1)
 
-        fut = self._loop.create_future()
-        cnt = next(self._cnt)
-        heappush(self._waiters, (priority, cnt, fut))
+    def _dispatch(self):
+        while self._running < self._concurrency and self._heap:
+            priority, _, job = heappop(self._heap)
+            if job.started or job.future.done() or priority != job.priority:
+                continue
+            self._drop(job)
+            now = time.monotonic()
+            if job.deadline is not None and now > job.deadline:
+                self.stats['stale'] += 1
+                job.future.set_exception(StaleRequest())
+                # mark the exception as retrieved: all callers may be gone already
+                job.future.exception()
+                continue
+            job.started = True
+            wait = now - job.queued
+            self.stats['last_wait'] = wait
+            if self._on_wait is not None:
+                self._on_wait(wait)
+            self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+            self._running += 1
+            asyncio.create_task(self._execute(job))
 
-        # Finally block should be called before the CancelledError
-        # handling as we don't want CancelledError to call
-        # _wake_up_first() and attempt to wake up itself.
+    async def _execute(self, job: _Job):
         try:
-            try:
-                await fut
-            finally:
-                self._waiters.remove((priority, cnt, fut))
-        except asyncio.exceptions.CancelledError:
-            if not self._locked:
-                self._wake_up_first()
+            self.stats['executed'] += 1
+            ret = await job.action()
+        except asyncio.CancelledError:
+            job.future.cancel()
             raise
+        except Exception as exc:
+            if not job.future.done():
+                job.future.set_exception(exc)
+                job.future.exception()
+        else:
+            if not job.future.done():
+                job.future.set_result(ret)
+        finally:
+            self._running -= 1
+            self._dispatch()
+
+
+class RttTracker:
+    """
+    Keeps the last `size` round-trip times and derives a request timeout from their percentile:
+    timeout = percentile * factor, clamped to [min_timeout, max_timeout]. Until `min_samples` are collected the
+    timeout is max_timeout.
+    """
+    def __init__(
+            self,
+            size: int = 100,
+            percentile: float = 0.95,
+            factor: float = 4,
+            min_timeout: float = 1.5,
+            max_timeout: float = 5,
+            min_samples: int = 10,
+    ):
+        self._samples = collections.deque(maxlen=size)
+        self.percentile = percentile
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_samples = min_samples
+        self._timeout = max_timeout
+        self._dirty = 0
+
+    def add(self, rtt: float):
+        self._samples.append(rtt)
+        self._dirty += 1
 
-        self._locked = True
-        return True
+    def value(self, percentile: float = None) -> typing.Optional[float]:
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        idx = min(int(len(samples) * (percentile or self.percentile)), len(samples) - 1)
+        return samples[idx]
 
-    def release(self):
-        """Release a lock.
+    def timeout(self) -> float:
+        if len(self._samples) < self.min_samples:
+            return self.max_timeout
+        # percentile is recalculated every few samples only
+        if self._dirty >= 10 or self._dirty == len(self._samples):
+            self._dirty = 0
+            self._timeout = min(max(self.value() * self.factor, self.min_timeout), self.max_timeout)
+        return self._timeout
 
-        When the lock is locked, reset it to unlocked, and return.
-        If any other coroutines are blocked waiting for the lock to become
-        unlocked, allow exactly one of them to proceed.
 
-        When invoked on an unlocked lock, a RuntimeError is raised.
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 4) -> float:
+    """
+    Exponential backoff with full jitter: random delay in [0, min(cap, base * 2 ** attempt)]
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
 
-        There is no return value.
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. While open, callers should not send requests (`is_open`) and a
+    single probe decides when to close it again.
+    """
+    def __init__(self, threshold: int = 3):
+        self.threshold = threshold
+        self.failures = 0
+        self.is_open = False
+        self.stats = {
+            'opened': 0,
+            'short_circuited': 0,
+        }
+
+    def success(self) -> bool:
         """
-        if self._locked:
-            self._locked = False
-            self._wake_up_first()
-        else:
-            raise RuntimeError('Lock is not acquired.')
+        :return: True if the breaker was open and is closed now
+        """
+        self.failures = 0
+        if self.is_open:
+            self.is_open = False
+            return True
+        return False
 
-    def _wake_up_first(self):
-        """Wake up the first waiter if it isn't done."""
-        if not self._waiters:
+    def failure(self) -> bool:
+        """
+        :return: True if the breaker has just opened
+        """
+        self.failures += 1
+        if not self.is_open and self.failures >= self.threshold:
+            self.is_open = True
+            self.stats['opened'] += 1
+            return True
+        return False
+
+
+class Debouncer:
+    """
+    Merges frequent requests for an action into one call. Action is called after `quiet` seconds without new requests,
+    but not later than `max_latency` seconds after the first request of a round.
+    >>> d = Debouncer(some_coro_function, quiet=1, max_latency=3)
+    ... d.request()
+    ... d.request()  # merged with the previous one
+    """
+    def __init__(self, action, quiet: float = 1, max_latency: float = 3):
+        self._action = action
+        self.quiet = quiet
+        self.max_latency = max(max_latency, quiet)
+        self._first: float = None
+        self._last: float = None
+        self._task: asyncio.Task = None
+        self._lck = asyncio.Lock()
+        self.stats = {
+            'requested': 0,
+            'merged': 0,
+            'executed': 0,
+        }
+
+    def request(self):
+        now = time.monotonic()
+        self.stats['requested'] += 1
+        self._last = now
+        if self._task is not None and not self._task.done():
+            self.stats['merged'] += 1
             return
+        self._first = now
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            deadline = min(self._last + self.quiet, self._first + self.max_latency)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        # requests made while action is running start a new round
+        self._task = None
+        async with self._lck:
+            self.stats['executed'] += 1
+            await self._action()
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def join_cmds(cmds: typing.Iterable[str], max_len: int) -> typing.List[str]:
+    """
+    Joins `port:value` commands into `;`-separated chunks no longer than `max_len`.
+    A command longer than `max_len` makes a chunk of its own.
+    """
+    ret = []
+    chunk = ''
+    for x in cmds:
+        if chunk and len(chunk) + 1 + len(x) > max_len:
+            ret.append(chunk)
+            chunk = ''
+        chunk = f'{chunk};{x}' if chunk else x
+    if chunk:
+        ret.append(chunk)
+    return ret
+
+
+class CommandBatcher:
+    """
+    Collects `port:value` commands submitted within `window` seconds and sends them as combined `;`-separated
+    commands. A later command for the same port replaces the earlier one. Every submitter gets a future resolved with
+    the response to the request that carried its command.
+    >>> b = CommandBatcher(send_coro_function, window=0.005, max_len=200)
+    ... await asyncio.gather(b.submit('1:1'), b.submit('2:0'))  # one request: cmd=1:1;2:0
+    """
+    def __init__(self, send, window: float = 0.005, max_len: int = 200):
+        self._send = send
+        self.window = window
+        self.max_len = max_len
+        self._pending: typing.Dict[str, typing.Tuple[str, typing.List[asyncio.Future]]] = {}
+        self._handle: typing.Optional[asyncio.TimerHandle] = None
+        self._tasks: typing.Set[asyncio.Task] = set()
+        self.stats = {
+            'submitted': 0,
+            'requests': 0,
+        }
+
+    def submit(self, cmd: str) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self.stats['submitted'] += 1
+        port = cmd.split(':', 1)[0]
+        _, futures = self._pending.pop(port, (None, []))
+        futures.append(fut)
+        self._pending[port] = (cmd, futures)
+        if self._handle is None:
+            self._handle = loop.call_later(self.window, self._flush)
+        return fut
+
+    def _flush(self):
+        self._handle = None
+        pending, self._pending = self._pending, {}
+        chunks = []
+        futures = []
+        for chunk in join_cmds([cmd for cmd, _ in pending.values()], self.max_len):
+            chunks.append(chunk)
+            futures.append([f for x in chunk.split(';') for f in pending[x.split(':', 1)[0]][1]])
+        for chunk, futs in zip(chunks, futures):
+            task = asyncio.create_task(self._run(chunk, futs))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, cmd: str, futures: typing.List[asyncio.Future]):
+        self.stats['requests'] += 1
         try:
-            _, _, fut = self._waiters[0]
-        except IndexError:
+            ret = await self._send(cmd)
+        except BaseException as exc:
+            for f in futures:
+                if not f.done():
+                    f.set_exception(exc)
+            if isinstance(exc, asyncio.CancelledError):
+                raise
             return
+        for f in futures:
+            if not f.done():
+                f.set_result(ret)
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for _, futures in self._pending.values():
+            for f in futures:
+                f.cancel()
+        self._pending.clear()
+        for task in self._tasks:
+            task.cancel()
+
+
+class IntentQueue:
+    """
+    Last-writer-wins queue of commands for one entity. Only one command is executed at a time, commands submitted
+    meanwhile collapse to the latest one, which is always delivered. Consecutive commands are started at least
+    `min_interval` seconds apart. Callers whose command was superseded are resolved when the command that replaced
+    it completes.
+    >>> q = IntentQueue(min_interval=0.1)
+    ... await q.submit(partial(some_coro_function, brightness=10))
+    """
+    def __init__(self, min_interval: float = 0.1):
+        self.min_interval = min_interval
+        self._pending: typing.Optional[typing.Callable[[], typing.Awaitable]] = None
+        self._waiters: typing.List[asyncio.Future] = []
+        self._task: typing.Optional[asyncio.Task] = None
+        self._last: float = None
+        self.stats = {
+            'submitted': 0,
+            'executed': 0,
+        }
+
+    async def submit(self, action: typing.Callable[[], typing.Awaitable]):
+        fut = asyncio.get_event_loop().create_future()
+        self.stats['submitted'] += 1
+        self._pending = action
+        self._waiters.append(fut)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await asyncio.shield(fut)
+
+    async def _run(self):
+        while self._pending is not None:
+            if self._last is not None:
+                delay = self._last + self.min_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            action, self._pending = self._pending, None
+            waiters, self._waiters = self._waiters, []
+            self._last = time.monotonic()
+            self.stats['executed'] += 1
+            try:
+                ret = await action()
+            except asyncio.CancelledError:
+                for f in waiters:
+                    f.cancel()
+                raise
+            except Exception as exc:
+                for f in waiters:
+                    if not f.done():
+                        f.set_exception(exc)
+                continue
+            for f in waiters:
+                if not f.done():
+                    f.set_result(ret)
 
-        # .done() necessarily means that a waiter will wake up later on and
-        # either take the lock, or, if it was cancelled and lock wasn't
-        # taken already, will hit this again and wake up a new waiter.
-        if not fut.done():
-            fut.set_result(True)
+    def cancel(self):
+        self._pending = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for f in self._waiters:
+            f.cancel()
+        self._waiters = []
 
 
 def map_reorder_rgb(rgb: list, from_: str, to_: str):
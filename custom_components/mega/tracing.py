@@ -0,0 +1,112 @@
+"""Трассировка циклов опроса"""
+import time
+import typing
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_CURRENT_SPAN: ContextVar[typing.Optional['Span']] = ContextVar("mega_trace_span", default=None)
+
+
+class Span:
+    """
+    Одна фаза цикла опроса: время начала и длительность (сек, от начала цикла), атрибуты, вложенные фазы
+    """
+    __slots__ = ('name', 'start', 'end', 'attrs', 'children', 'error')
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.start = time.monotonic()
+        self.end: typing.Optional[float] = None
+        self.attrs = attrs
+        self.children: typing.List[Span] = []
+        self.error: typing.Optional[str] = None
+
+    @property
+    def duration(self) -> typing.Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    def as_dict(self, origin: float) -> dict:
+        ret = {
+            "name": self.name,
+            "start": round(self.start - origin, 4),
+            "duration": None if self.end is None else round(self.end - self.start, 4),
+        }
+        if self.attrs:
+            ret["attrs"] = self.attrs
+        if self.error is not None:
+            ret["error"] = self.error
+        if self.children:
+            ret["children"] = [x.as_dict(origin) for x in self.children]
+        return ret
+
+
+class PollTracer:
+    """
+    Дерево фаз для каждого цикла опроса, последние size циклов хранятся в кольцевом буфере. Текущая фаза
+    передается через contextvars, поэтому фазы, которые выполняются параллельно в разных задачах, попадают
+    к своему родителю. Выключенный трассировщик ничего не создает
+    """
+
+    def __init__(self, size: int = 0):
+        self.enabled = size > 0
+        self.cycles: typing.Deque[typing.Tuple[float, Span]] = deque(maxlen=max(size, 1))
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Вложенная фаза, вне цикла опроса не записывается
+        """
+        parent = _CURRENT_SPAN.get() if self.enabled else None
+        if parent is None:
+            yield None
+            return
+        span = Span(name, attrs)
+        parent.children.append(span)
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = repr(exc)
+            raise
+        finally:
+            span.end = time.monotonic()
+            _CURRENT_SPAN.reset(token)
+
+    @contextmanager
+    def cycle(self, name: str, **attrs):
+        """
+        Корневая фаза цикла, после завершения цикл попадает в буфер
+        """
+        if not self.enabled:
+            yield None
+            return
+        span = Span(name, attrs)
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = repr(exc)
+            raise
+        finally:
+            span.end = time.monotonic()
+            _CURRENT_SPAN.reset(token)
+            self.cycles.append((time.time() - span.duration, span))
+
+    def wrap(self, name: str, coro: typing.Awaitable, **attrs) -> typing.Awaitable:
+        """
+        Обертка корутины в фазу, при выключенной трассировке возвращает корутину как есть
+        """
+        if not self.enabled:
+            return coro
+        return self._traced(name, coro, attrs)
+
+    async def _traced(self, name, coro, attrs):
+        with self.span(name, **attrs):
+            return await coro
+
+    def as_list(self) -> typing.List[dict]:
+        return [
+            dict(span.as_dict(span.start), ts=round(ts, 3))
+            for ts, span in self.cycles
+        ]